@@ -0,0 +1,116 @@
+import threading
+import time
+import helper_config as hc
+
+# error codes botocore's retry handlers treat as throttling
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                          'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+                          'TransactionInProgressException', 'RequestLimitExceeded', 'BandwidthLimitExceeded',
+                          'LimitExceededException', 'RequestThrottled', 'SlowDown', 'PriorRequestNotComplete',
+                          'EC2ThrottledException')
+
+
+class OperationMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+
+class ApiMetrics:
+    """Calls, retries, throttled responses, errors & latency per AWS operation, from every boto3 client.
+    Latency covers the whole call including retries and the adaptive rate limiter's waits."""
+
+    def __init__(self):
+        self.operations = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+
+    def _operation(self, name):
+        """Call with _lock held"""
+        metrics = self.operations.get(name)
+        if metrics is None:
+            metrics = self.operations[name] = OperationMetrics()
+        return metrics
+
+    @staticmethod
+    def _name(model):
+        return f"{model.service_model.service_name}.{model.name}"
+
+    def _before_call(self, model, context, **kwargs):
+        # after-call-error only passes exception & context, so the operation name travels in the context
+        context['madzumo_metrics_operation'] = self._name(model)
+        context['madzumo_metrics_start'] = time.monotonic()
+
+    def _record(self, context, retries=0, failed=False):
+        name = context.get('madzumo_metrics_operation')
+        if name is None:
+            return
+        seconds = time.monotonic() - context['madzumo_metrics_start']
+        with self._lock:
+            metrics = self._operation(name)
+            metrics.calls += 1
+            metrics.errors += failed
+            metrics.retries += retries
+            metrics.total_seconds += seconds
+            metrics.max_seconds = max(metrics.max_seconds, seconds)
+
+    def _after_call(self, parsed, context, **kwargs):
+        self._record(context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+    def _after_call_error(self, exception, context, **kwargs):
+        """Transport failures (EndpointConnectionError, timeouts) once botocore gave up retrying them"""
+        response = getattr(exception, 'response', None) or {}
+        self._record(context, response.get('ResponseMetadata', {}).get('RetryAttempts', 0), failed=True)
+
+    def _needs_retry(self, response, operation, **kwargs):
+        # seen once per attempt, before the retry handlers decide. Never answers, so retry decisions are unchanged
+        if response is None:
+            return
+        error_code = response[1].get('Error', {}).get('Code', '')
+        if error_code in THROTTLING_ERROR_CODES:
+            with self._lock:
+                self._operation(self._name(operation)).throttles += 1
+
+    def instrument(self, client):
+        """Count every API call the client makes"""
+        client.meta.events.register('before-call.*.*', self._before_call)
+        client.meta.events.register('after-call.*.*', self._after_call)
+        client.meta.events.register('after-call-error.*.*', self._after_call_error)
+        client.meta.events.register_first('needs-retry.*.*', self._needs_retry)
+        return client
+
+    def totals(self):
+        """{'calls': .., 'errors': .., 'retries': .., 'throttles': ..} over every operation"""
+        with self._lock:
+            operations = list(self.operations.values())
+        return {counter: sum(getattr(metrics, counter) for metrics in operations)
+                for counter in ('calls', 'errors', 'retries', 'throttles')}
+
+    def print_summary(self, limit=10):
+        """Operations that were retried, throttled or failed first, then the slowest"""
+        with self._lock:
+            operations = sorted(self.operations.items(),
+                                key=lambda x: (x[1].throttles + x[1].retries + x[1].errors, x[1].total_seconds),
+                                reverse=True)[:limit]
+        if not operations:
+            return
+        totals = self.totals()
+        lines = [f"AWS API: {totals['calls']} calls, {totals['retries']} retries, {totals['throttles']} throttled, "
+                 f"{totals['errors']} errors",
+                 f"{'Operation':<40} {'Calls':>6} {'Retries':>8} {'Throttled':>10} {'Errors':>7} {'Avg':>7} "
+                 f"{'Max':>7}"]
+        for name, metrics in operations:
+            lines.append(f"{name[:40]:<40} {metrics.calls:>6} {metrics.retries:>8} {metrics.throttles:>10} "
+                         f"{metrics.errors:>7} {metrics.total_seconds / max(metrics.calls, 1):6.2f}s "
+                         f"{metrics.max_seconds:6.2f}s")
+        hc.console_message(lines, hc.ConsoleColors.info, total_chars=0)
+
+
+api_metrics = ApiMetrics()
@@ -0,0 +1,156 @@
+import helper_config as hc
+
+
+class Artifact:
+    """A pinned tool the Operator Node needs. fetch downloads file_name from upstream into the current
+    directory, install puts it in place and installed_check exits 0 when the pinned version is already there.
+    If checksum_url is set the upstream sha256 is verified. Otherwise nothing upstream is verified: the hash is
+    recorded on first download and only guards the cached copy in S3 against corruption."""
+
+    def __init__(self, name, version, file_name, fetch, install, installed_check, checksum_url=''):
+        self.name = name
+        self.version = version
+        self.file_name = file_name
+        self.fetch = fetch
+        self.install = install
+        self.installed_check = installed_check
+        self.checksum_url = checksum_url
+
+    @property
+    def function_name(self):
+        return 'artifact_' + ''.join(char if char.isalnum() else '_' for char in self.name)
+
+
+KUBECTL_VERSION = 'v1.29.3'
+HELM_VERSION = 'v3.14.3'
+ANSIBLE_VERSION = '9.4.0'
+KUBERNETES_CLIENT_VERSION = '29.0.0'
+PYTHON_REQUIREMENTS = f"ansible=={ANSIBLE_VERSION} kubernetes=={KUBERNETES_CLIENT_VERSION}"
+
+PINNED_ARTIFACTS = [
+    Artifact('kubectl', KUBECTL_VERSION, 'kubectl',
+             fetch=f"curl -fsSLo kubectl https://dl.k8s.io/release/{KUBECTL_VERSION}/bin/linux/amd64/kubectl",
+             install="sudo install -o root -g root -m 0755 kubectl /usr/local/bin/kubectl",
+             installed_check=f"kubectl version --client 2>/dev/null | grep -q {KUBECTL_VERSION}",
+             checksum_url=f"https://dl.k8s.io/release/{KUBECTL_VERSION}/bin/linux/amd64/kubectl.sha256"),
+    Artifact('helm', HELM_VERSION, f"helm-{HELM_VERSION}-linux-amd64.tar.gz",
+             fetch=f"curl -fsSLO https://get.helm.sh/helm-{HELM_VERSION}-linux-amd64.tar.gz",
+             install=f"tar -zxf helm-{HELM_VERSION}-linux-amd64.tar.gz && sudo mv linux-amd64/helm /usr/local/bin/helm",
+             installed_check=f"helm version --short 2>/dev/null | grep -q {HELM_VERSION}",
+             checksum_url=f"https://get.helm.sh/helm-{HELM_VERSION}-linux-amd64.tar.gz.sha256sum"),
+    # no upstream checksum for a pip download, see Artifact. The pins are the version, so changing one re-caches
+    Artifact('python-wheels', f"ansible-{ANSIBLE_VERSION}-kubernetes-{KUBERNETES_CLIENT_VERSION}", 'wheelhouse.tar.gz',
+             fetch=f"python3 -m pip download -q -d wheelhouse {PYTHON_REQUIREMENTS} && "
+                   f"tar -czf wheelhouse.tar.gz wheelhouse",
+             install=f"tar -xzf wheelhouse.tar.gz && "
+                     f"python3 -m pip install -q --user --no-index --find-links wheelhouse {PYTHON_REQUIREMENTS}",
+             installed_check=f"python3 -m pip show ansible 2>/dev/null | grep -qx 'Version: {ANSIBLE_VERSION}' && "
+                             f"python3 -m pip show kubernetes 2>/dev/null | "
+                             f"grep -qx 'Version: {KUBERNETES_CLIENT_VERSION}'"),
+]
+
+
+class ArtifactCache:
+    """Pinned tool binaries & pip wheels kept in the pipeline S3 bucket under prefix/<name>/<version>/.
+    Renders the shell script the Operator Node runs: every artifact is handled in parallel, skipped if already
+    installed, restored from the bucket when cached, otherwise fetched upstream and uploaded for next time.
+    Each file sits next to a .sha256 file that is checked before anything is installed (the upstream checksum
+    where the artifact has a checksum_url)."""
+
+    def __init__(self, s3_setup, artifacts=None, prefix='artifacts', work_dir='~/madzumo-artifacts'):
+        self.s3_setup = s3_setup
+        self.artifacts = PINNED_ARTIFACTS if artifacts is None else artifacts
+        self.prefix = prefix
+        self.work_dir = work_dir
+
+    def artifact_key(self, artifact):
+        return f"{self.prefix}/{artifact.name}/{artifact.version}/{artifact.file_name}"
+
+    def cached_artifacts(self):
+        """Names of artifacts whose file and checksum are both in the bucket"""
+        keys = self.s3_setup.list_bucket_keys(f"{self.prefix}/")
+        return [artifact.name for artifact in self.artifacts
+                if self.artifact_key(artifact) in keys and f"{self.artifact_key(artifact)}.sha256" in keys]
+
+    def _s3_url(self, artifact):
+        return f"s3://{self.s3_setup.bucket_name}/{self.artifact_key(artifact)}"
+
+    def _render_artifact(self, artifact, cached):
+        file_name = artifact.file_name
+        lines = [f"{artifact.function_name}() {{",
+                 f"    if {artifact.installed_check}; then",
+                 f"        echo \"{artifact.name} {artifact.version} already installed\"",
+                 "        return 0",
+                 "    fi"]
+        if cached:
+            lines += [f"    aws s3 cp --only-show-errors {self._s3_url(artifact)} {file_name} || return 1",
+                      f"    aws s3 cp --only-show-errors {self._s3_url(artifact)}.sha256 {file_name}.sha256 "
+                      f"|| return 1"]
+        else:
+            lines.append(f"    {artifact.fetch} || return 1")
+            if artifact.checksum_url:
+                lines.append(f"    curl -fsSL {artifact.checksum_url} | cut -d' ' -f1 > {file_name}.sha256 "
+                             f"|| return 1")
+            else:
+                lines.append(f"    sha256sum {file_name} | cut -d' ' -f1 > {file_name}.sha256 || return 1")
+        lines.append(f"    echo \"$(cat {file_name}.sha256)  {file_name}\" | sha256sum -c --quiet - || return 1")
+        if not cached:
+            lines.append(f"    aws s3 cp --only-show-errors {file_name} {self._s3_url(artifact)} && "
+                         f"aws s3 cp --only-show-errors {file_name}.sha256 {self._s3_url(artifact)}.sha256 "
+                         f"|| echo \"Unable to cache {artifact.name} in S3\"")
+        lines += [f"    {artifact.install}", "}"]
+        return lines
+
+    def render_install_script(self):
+        """Shell script that installs every artifact in parallel and exits non-zero if any of them failed"""
+        cached = self.cached_artifacts()
+        hc.console_message([f"Artifact cache: {artifact.name} "
+                            f"({'cached' if artifact.name in cached else 'download & cache'})"
+                            for artifact in self.artifacts], hc.ConsoleColors.info, total_chars=0)
+        lines = ["set -o pipefail",
+                 f"mkdir -p {self.work_dir} && cd {self.work_dir} || exit 1"]
+        for artifact in self.artifacts:
+            lines += self._render_artifact(artifact, artifact.name in cached)
+        for artifact in self.artifacts:
+            lines.append(f"{artifact.function_name} > {artifact.function_name}.log 2>&1 & pid_{artifact.function_name}=$!")
+        lines.append("artifact_status=0")
+        for artifact in self.artifacts:
+            lines += [f"wait $pid_{artifact.function_name} || {{ echo \"{artifact.name} install FAILED\"; "
+                      f"artifact_status=1; }}",
+                      f"cat {artifact.function_name}.log"]
+        lines += ["cd ~", "test $artifact_status -eq 0"]
+        return '\n'.join(lines) + '\n'
+
+
+class TerraformCache:
+    """Terraform provider plugins & downloaded modules kept in the pipeline S3 bucket under prefix/.
+    Restored onto the Operator Node before `terraform init` so a new node does not download the AWS provider and
+    the eks/vpc modules again, and saved back after init (aws s3 sync only uploads what changed).
+    TF_PLUGIN_CACHE_DIR must be exported in the same script as init."""
+
+    def __init__(self, s3_setup, terraform_dir, prefix='terraform', plugin_cache_dir='~/.terraform.d/plugin-cache'):
+        self.s3_setup = s3_setup
+        self.terraform_dir = terraform_dir
+        self.prefix = prefix
+        self.plugin_cache_dir = plugin_cache_dir
+
+    def _sync_pairs(self):
+        """[(S3 url, node directory)]"""
+        s3_url = f"s3://{self.s3_setup.bucket_name}/{self.prefix}"
+        return [(f"{s3_url}/plugin-cache", self.plugin_cache_dir),
+                (f"{s3_url}/modules", f"{self.terraform_dir}/.terraform/modules")]
+
+    def render_restore_script(self):
+        lines = [f"mkdir -p {self.plugin_cache_dir}",
+                 f"export TF_PLUGIN_CACHE_DIR={self.plugin_cache_dir}"]
+        for s3_url, directory in self._sync_pairs():
+            lines.append(f"aws s3 sync --only-show-errors {s3_url} {directory} "
+                         f"|| echo \"Terraform cache not restored from {s3_url}\"")
+        return '\n'.join(lines) + '\n'
+
+    def render_save_script(self):
+        lines = []
+        for s3_url, directory in self._sync_pairs():
+            lines.append(f"aws s3 sync --only-show-errors {directory} {s3_url} "
+                         f"|| echo \"Unable to cache {directory} in S3\"")
+        return '\n'.join(lines) + '\n'
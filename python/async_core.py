@@ -0,0 +1,38 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3 and paramiko block, so they run on bounded thread pools and coroutines await them.
+# Separate pools keep a burst of API calls from starving SSH commands (and file transfers from both)
+AWS_WORKERS = 16
+aws_executor = ThreadPoolExecutor(max_workers=AWS_WORKERS, thread_name_prefix='madzumo-aws')
+ssh_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='madzumo-ssh')
+transfer_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='madzumo-transfer')
+
+
+async def run_blocking(executor, function, *args, **kwargs):
+    """Await a blocking call running on one of the executors above"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(function, *args, **kwargs))
+
+
+def run_sync(coroutine):
+    """Run a coroutine to completion from synchronous code (the menu, StepScheduler worker threads).
+    Each call gets its own event loop, the executors are shared."""
+    return asyncio.run(coroutine)
+
+
+class AsyncAWS:
+    """Awaitable boto3 calls on the shared registry clients of an AWSbase object"""
+
+    def __init__(self, aws_base):
+        self.aws_base = aws_base
+
+    async def call(self, service, operation, **kwargs):
+        client = self.aws_base.get_client(service)
+        return await run_blocking(aws_executor, getattr(client, operation), **kwargs)
+
+    async def paginate(self, service, operation, **kwargs):
+        """Every page of a paginated operation"""
+        paginator = self.aws_base.get_client(service).get_paginator(operation)
+        return await run_blocking(aws_executor, lambda: list(paginator.paginate(**kwargs)))
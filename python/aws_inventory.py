@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class ResourceInventory:
+    """In-memory snapshot of the EC2 resources this demo works with: instances & security groups tagged
+    tag_key:tag_value, key pairs and the default VPC. Each kind is loaded with one paginated Describe call and
+    served from memory for ttl seconds. Anything that creates, terminates or deletes a resource must call
+    invalidate() for that kind so the next lookup reloads it. get_ec2_client is called on every load so the
+    inventory follows credential changes."""
+
+    kinds = ('instances', 'security_groups', 'key_pairs', 'vpcs')
+
+    def __init__(self, get_ec2_client, tag_key, tag_value, ttl=30):
+        self._get_ec2_client = get_ec2_client
+        self.tag_key = tag_key
+        self.tag_value = tag_value
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ec2_client(self):
+        return self._get_ec2_client()
+
+    def _tag_filter(self):
+        return [{'Name': f'tag:{self.tag_key}', 'Values': [self.tag_value]}]
+
+    def _load_instances(self):
+        instances = []
+        paginator = self.ec2_client.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=self._tag_filter()):
+            for reservation in page['Reservations']:
+                instances.extend(reservation['Instances'])
+        return instances
+
+    def _load_security_groups(self):
+        groups = []
+        paginator = self.ec2_client.get_paginator('describe_security_groups')
+        for page in paginator.paginate(Filters=self._tag_filter()):
+            groups.extend(page['SecurityGroups'])
+        return groups
+
+    def _load_key_pairs(self):
+        # key pairs are created without tags, so only the demo's <instance name>-keypair names are listed.
+        # describe_key_pairs does not paginate
+        return self.ec2_client.describe_key_pairs(Filters=[{'Name': 'key-name', 'Values': ['*-keypair']}])['KeyPairs']
+
+    def _load_vpcs(self):
+        return self.ec2_client.describe_vpcs(Filters=[{'Name': 'is-default', 'Values': ['true']}])['Vpcs']
+
+    def _get(self, kind):
+        with self._lock:
+            entry = self._entries.get(kind)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            data = getattr(self, f"_load_{kind}")()
+            self._entries[kind] = (time.monotonic(), data)
+            return data
+
+    def invalidate(self, *kinds):
+        """Drop the cached kinds (all of them if none given)"""
+        with self._lock:
+            for kind in kinds or self.kinds:
+                self._entries.pop(kind, None)
+
+    @staticmethod
+    def _name_tag(resource):
+        for tag in resource.get('Tags', []):
+            if tag['Key'] == 'Name':
+                return tag['Value']
+        return None
+
+    def instances(self, name=None, states=None):
+        return [instance for instance in self._get('instances')
+                if (name is None or self._name_tag(instance) == name)
+                and (states is None or instance['State']['Name'] in states)]
+
+    def security_group(self, name):
+        for group in self._get('security_groups'):
+            if self._name_tag(group) == name:
+                return group
+        return None
+
+    def key_pair(self, key_name):
+        for key_pair in self._get('key_pairs'):
+            if key_pair['KeyName'] == key_name:
+                return key_pair
+        return None
+
+    def default_vpc_id(self):
+        vpcs = self._get('vpcs')
+        return vpcs[0]['VpcId'] if vpcs else None
@@ -1,12 +1,31 @@
 # import boto3
 import os
-import boto3
 import configparser
 import helper_config as hc
 import subprocess
+import threading
+import cassette
+from api_metrics import api_metrics
+from async_core import AsyncAWS, AWS_WORKERS
+from tracing import instrument_boto3_client
 
 
 class AWSbase:
+    # boto3 sessions & clients shared by every AWSbase object in the process.
+    # Keyed by credentials + region (+ service) so endpoint resolution & connection pools are built only once.
+    # boto3 resources are not thread-safe, so those are only shared within a thread
+    _session_registry = {}
+    _client_registry = {}
+    _thread_resources = threading.local()
+    _registry_generation = 0  # bumped by reset_client_registry, drops every thread's resources
+    _registry_lock = threading.Lock()
+    # called with every new client so API calls can be traced & counted (and slowed down by the benchmarks).
+    # The cassette comes last: a replayed call skips every before-call handler registered after it
+    client_hooks = [instrument_boto3_client, api_metrics.instrument, cassette.instrument]
+    # adaptive: jittered exponential backoff plus a client side rate limiter that slows down once AWS throttles.
+    # Clients are shared, so the limiter sees every caller in the process
+    retry_config = {'mode': 'adaptive', 'max_attempts': 10}
+
     def __init__(self, key_id='', secret_id='', region='us-east-1'):
         self.key_id = key_id
         self.secret_id = secret_id
@@ -16,6 +35,79 @@ class AWSbase:
         self.tag_identity_value = 'demo'
         self.instance_ami = 'ami-0c101f26f147fa7fd'
         self.aws_account_number = ''
+        # point every client at a local stand-in (moto server, minio) instead of AWS
+        self.endpoint_url = os.environ.get('MADZUMO_AWS_ENDPOINT_URL', '')
+
+    def _session_key(self):
+        # empty keys fall back to boto3's default chain (environment variables, ~/.aws/credentials)
+        return self.key_id or None, self.secret_id or None, self.region
+
+    def _get_session(self):
+        """Call with _registry_lock held"""
+        session_key = self._session_key()
+        session = AWSbase._session_registry.get(session_key)
+        if session is None:
+            import boto3  # loaded on the first AWS call, not when the menu starts
+            session = boto3.Session(aws_access_key_id=session_key[0], aws_secret_access_key=session_key[1],
+                                    region_name=session_key[2])
+            AWSbase._session_registry[session_key] = session
+        return session
+
+    @classmethod
+    def _client_config(cls):
+        from botocore.config import Config
+        # one pooled connection per aws_executor thread
+        return Config(retries=dict(cls.retry_config), max_pool_connections=AWS_WORKERS)
+
+    def get_client(self, service):
+        """Shared, thread-safe boto3 client for this object's credentials & region"""
+        client_key = self._session_key() + (service, self.endpoint_url)
+        client = AWSbase._client_registry.get(client_key)
+        if client is None:
+            with AWSbase._registry_lock:
+                client = AWSbase._client_registry.get(client_key)
+                if client is None:
+                    client = self._get_session().client(service, endpoint_url=self.endpoint_url or None,
+                                                        config=self._client_config())
+                    for client_hook in AWSbase.client_hooks:
+                        client_hook(client)
+                    AWSbase._client_registry[client_key] = client
+        return client
+
+    def get_credentials(self):
+        """botocore credentials of the shared session, for requests signed outside a boto3 client"""
+        with AWSbase._registry_lock:
+            return self._get_session().get_credentials()
+
+    @property
+    def async_api(self):
+        """Awaitable boto3 calls (AsyncAWS) on this object's clients"""
+        return AsyncAWS(self)
+
+    def get_resource(self, service):
+        """boto3 resource for this object's credentials & region, shared with the calling thread only"""
+        thread_resources = AWSbase._thread_resources
+        if getattr(thread_resources, 'generation', None) != AWSbase._registry_generation:
+            thread_resources.registry = {}
+            thread_resources.generation = AWSbase._registry_generation
+        resource_key = self._session_key() + (service, self.endpoint_url)
+        resource = thread_resources.registry.get(resource_key)
+        if resource is None:
+            with AWSbase._registry_lock:
+                resource = self._get_session().resource(service, endpoint_url=self.endpoint_url or None,
+                                                        config=self._client_config())
+            for client_hook in AWSbase.client_hooks:
+                client_hook(resource.meta.client)
+            thread_resources.registry[resource_key] = resource
+        return resource
+
+    @classmethod
+    def reset_client_registry(cls):
+        """Drop every shared session/client. Needed when credentials behind the default chain change"""
+        with cls._registry_lock:
+            cls._session_registry.clear()
+            cls._client_registry.clear()
+            cls._registry_generation += 1
 
     def set_aws_credentials_envars(self):
         try:
@@ -28,6 +120,7 @@ class AWSbase:
             os.environ['AWS_ACCESS_KEY_ID'] = self.key_id
             os.environ['AWS_SECRET_ACCESS_KEY'] = self.secret_id
             os.environ['AWS_DEFAULT_REGION'] = self.region
+            AWSbase.reset_client_registry()
             hc.console_message(['AWS Credentials set successfully!'], hc.ConsoleColors.title)
             return True
         except Exception as ex:
@@ -45,6 +138,7 @@ class AWSbase:
             subprocess.run(['aws', 'configure', 'set', 'aws_access_key_id', self.key_id], check=True)
             subprocess.run(['aws', 'configure', 'set', 'aws_secret_access_key', self.secret_id], check=True)
             subprocess.run(['aws', 'configure', 'set', 'region', self.region], check=True)
+            AWSbase.reset_client_registry()
             hc.console_message(['AWS Credentials set successfully!'], hc.ConsoleColors.title)
             return True
         except subprocess.CalledProcessError as e:
@@ -63,11 +157,7 @@ class AWSbase:
             if self.key_id == '' or self.secret_id == '':
                 hc.console_message(["Missing AWS Access & Secret Key ID"], hc.ConsoleColors.error)
                 return False
-            session = boto3.Session(
-                aws_access_key_id=self.key_id,
-                aws_secret_access_key=self.secret_id,
-                region_name=self.region)
-            aws_client = session.client('iam')
+            aws_client = self.get_client('iam')
             user_details = aws_client.get_user()
             account_number = user_details['User']['Arn'].split(':')[4]
             self.aws_account_number = account_number
@@ -84,7 +174,7 @@ class AWSbase:
             return False
 
     def get_arn_role_info(self):
-        sts_client = boto3.client('sts')
+        sts_client = self.get_client('sts')
         response = sts_client.get_caller_identity()
         # Extract role ARN
         role_arn = response['Arn']
@@ -107,7 +197,7 @@ class AWSbase:
         return aws_credentials
 
     def get_eks_cluster_status(self, cluster_name):
-        eks_client = boto3.client('eks')
+        eks_client = self.get_client('eks')
         try:
             response = eks_client.describe_cluster(name=cluster_name)
             if response['cluster']:
@@ -0,0 +1,73 @@
+"""Startup budget for start_demo.
+
+Imports start_demo in a fresh interpreter with `python -X importtime`, several times, and reports the best
+cumulative import time of start_demo plus the slowest modules it pulls in. Exits 1 when the import takes longer
+than the budget or when a module that should load lazily (boto3, paramiko, ...) is imported at startup.
+
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --budget-ms 60 --runs 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PYTHON_DIR)
+
+import helper_config as hc
+
+# only loaded once a menu option needs AWS, SSH or the pipeline engine
+LAZY_MODULES = ('boto3', 'botocore', 'paramiko', 'kubernetes', 'pytz', 'asyncio', 'concurrent.futures',
+                'operator_config', 'ec2_config', 's3_config', 'status_config', 'ssh_client')
+
+
+def measure_imports(module='start_demo'):
+    """{module: (self microseconds, cumulative microseconds)} for one fresh interpreter"""
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=PYTHON_DIR,
+                               capture_output=True, text=True, check=True)
+    timings = {}
+    for line in completed.stderr.splitlines():
+        # import time:  self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_time), int(cumulative))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='start_demo import time budget (python -X importtime)')
+    parser.add_argument('--budget-ms', type=float, default=50.0, help='allowed cumulative import time of start_demo')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to measure, the best one counts')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to list')
+    args = parser.parse_args()
+
+    runs = [measure_imports() for _ in range(args.runs)]
+    totals = [timings['start_demo'][1] / 1000 for timings in runs]
+    best = runs[totals.index(min(totals))]
+    # everything start_demo pulls in is listed before it. Modules imported by site are not its cost
+    names = list(best)
+    own_modules = names[names.index('site') + 1:] if 'site' in names else names
+    slowest = sorted(own_modules, key=lambda name: best[name][1], reverse=True)[:args.top]
+
+    lines = [f"start_demo import: best {min(totals):.1f} ms, median {statistics.median(totals):.1f} ms "
+             f"over {args.runs} runs (budget {args.budget_ms:.0f} ms)",
+             f"{'Module':<40} {'Self':>9} {'Cumulative':>11}"]
+    for name in slowest:
+        lines.append(f"{name[:40]:<40} {best[name][0] / 1000:7.1f}ms {best[name][1] / 1000:9.1f}ms")
+    hc.console_message(lines, hc.ConsoleColors.info, total_chars=0)
+
+    problems = [f"{module} is imported at startup" for module in LAZY_MODULES
+                if any(name == module or name.startswith(f"{module}.") for name in own_modules)]
+    if min(totals) > args.budget_ms:
+        problems.append(f"start_demo import took {min(totals):.1f} ms, budget is {args.budget_ms:.0f} ms")
+    if problems:
+        hc.console_message(['Startup budget exceeded'] + problems, hc.ConsoleColors.error, total_chars=0)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
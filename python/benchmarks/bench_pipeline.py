@@ -0,0 +1,348 @@
+"""Offline benchmark of the pipeline orchestrator.
+
+Runs StartDemo._setup_the_show (fresh, then resumed), a warm standby teardown & setup (Operator Node stopped
+and started again) and finally _destroy_the_show end to end against a local moto server and a scripted local sshd, so no AWS account or EKS cluster is touched. For every scenario it reports
+wall time, AWS API calls and SSH handshakes and appends the result to results/history.jsonl. A run is compared
+with results/baseline.json and exits 1 when a scenario got slower than the tolerance or made more API calls or
+SSH handshakes than the baseline.
+With --record the AWS calls & SSH commands of the run are stored in a cassette, which --replay plays back
+instead of using moto & the sshd (compared with nothing, --replay-latency replays at the recorded speed).
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --latency '*=0.05' --latency ec2.RunInstances=1.5
+    python benchmarks/bench_pipeline.py --throttle 'ec2.Describe*=0.3'
+    python benchmarks/bench_pipeline.py --save-baseline
+    python benchmarks/bench_pipeline.py --record pipeline.json.gz
+    python benchmarks/bench_pipeline.py --replay pipeline.json.gz
+"""
+import argparse
+import builtins
+import contextlib
+import fnmatch
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from moto.server import ThreadedMotoServer
+import cassette
+import helper_config as hc
+from aws_madzumo import AWSbase
+from api_metrics import api_metrics
+from ssh_client import ssh_pool
+from tracing import tracer
+from k8s_readiness import READINESS_SENTINEL
+from local_sshd import LocalSSHServer, ScriptedCommand
+
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, 'results')
+BASELINE_FILE = os.path.join(RESULTS_DIR, 'baseline.json')
+HISTORY_FILE = os.path.join(RESULTS_DIR, 'history.jsonl')
+SCENARIOS = ('setup', 'setup-resume', 'standby-destroy', 'standby-setup', 'destroy')
+
+# stand-ins for the Operator Node: delays roughly scaled down from a real run, outputs the parsers rely on
+OPERATOR_SCRIPT = [
+    # the readiness check carries its own source, so match it before any kubectl / terraform rule
+    ScriptedCommand(READINESS_SENTINEL, delay=0.4,
+                    stdout='{"workload": "deployment/madzumo-ops/frontend", "seconds": 0.3, "detail": "1/1 available"}\n'
+                           '{"workload": "service/madzumo-ops/frontend", "seconds": 0.4, "detail": "web.elb.local"}\n'
+                           '{"ready": true, "not_ready": {}}\n'),
+    # the user-data bootstrap had the whole instance boot to install the tools
+    ScriptedCommand(r'madzumo-bootstrap\.status', stdout='+ sudo yum -y install terraform\nComplete!\n', delay=0.1),
+    ScriptedCommand(r'artifact_status', stdout='kubectl v1.29.3 already installed\n', delay=0.2),
+    ScriptedCommand(r'terraform (-chdir=\S+ )?apply', stdout='Apply complete! Resources: 58 added\n', delay=0.5),
+    ScriptedCommand(r'terraform (-chdir=\S+ )?destroy', stdout='Destroy complete! Resources: 58 destroyed\n',
+                    delay=0.5),
+    # -detailed-exitcode: 2 = changes to apply
+    ScriptedCommand(r'terraform (-chdir=\S+ )?plan', stdout='Plan: 58 to add, 0 to change, 0 to destroy.\n',
+                    exit_status=2, delay=0.2),
+    ScriptedCommand(r'terraform (-chdir=\S+ )?init', stdout='Terraform has been successfully initialized!\n',
+                    delay=0.2),
+    # LoadBalancer services linger until their ELB is deleted
+    ScriptedCommand(r'kubectl wait --for=delete', delay=0.3),
+    # profile_tasks recap at the end
+    ScriptedCommand(r'ansible-playbook', stdout='PLAY RECAP *****\nlocalhost : ok=5 changed=3 failed=0\n'
+                                                f"{'=' * 40}\nApply YAML {'-' * 30} 12.34s\n"
+                                                f"Ensure namespace exists {'-' * 17} 0.81s\n",
+                    delay=0.3),
+    ScriptedCommand(r'kubectl get svc -A', stdout='madzumo-ops frontend web.elb.local\n'
+                                                  'monitoring monitoring-kube-prometheus-prometheus prom.elb.local\n'
+                                                  'monitoring monitoring-grafana grafana.elb.local\n'),
+]
+
+
+class LatencyInjector:
+    """Sleeps before each AWS request is sent. Rules are 'service.Operation=seconds' with fnmatch patterns,
+    e.g. 'ec2.*=0.1' or '*=0.05'; the first matching rule wins"""
+
+    def __init__(self, rules):
+        self.rules = []
+        for rule in rules:
+            pattern, seconds = rule.rsplit('=', 1)
+            self.rules.append((pattern, float(seconds)))
+
+    def delay_for(self, operation):
+        for pattern, seconds in self.rules:
+            if fnmatch.fnmatchcase(operation, pattern):
+                return seconds
+        return 0.0
+
+    def _before_send(self, event_name, **kwargs):
+        # event_name is before-send.<service>.<Operation>
+        delay = self.delay_for(event_name.split('.', 1)[1])
+        if delay:
+            time.sleep(delay)
+
+    def __call__(self, client):
+        client.meta.events.register('before-send.*.*', self._before_send)
+        return client
+
+
+class _RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class ThrottleInjector:
+    """Answers a share of the matching AWS requests with the service's throttling error instead of sending them,
+    so the adaptive retries & rate limiter get exercised. Rules are 'service.Operation=probability' like
+    LatencyInjector's, the first matching rule wins. Seeded, so runs throttle alike."""
+
+    # (status, body) of a throttling error for each protocol botocore parses
+    RESPONSES = {
+        'ec2': (503, b'<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                     b'<Message>Request limit exceeded.</Message></Error></Errors></Response>'),
+        'query': (400, b'<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>'
+                       b'<Message>Rate exceeded</Message></Error></ErrorResponse>'),
+        'rest-xml': (503, b'<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>'),
+        'json': (400, b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'),
+        'rest-json': (429, b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'),
+    }
+
+    def __init__(self, rules, seed=0):
+        self.rules = []
+        for rule in rules:
+            pattern, probability = rule.rsplit('=', 1)
+            self.rules.append((pattern, float(probability)))
+        self._random = random.Random(seed)
+
+    def probability_for(self, operation):
+        for pattern, probability in self.rules:
+            if fnmatch.fnmatchcase(operation, pattern):
+                return probability
+        return 0.0
+
+    def __call__(self, client):
+        from botocore.awsrequest import AWSResponse
+        status, body = self.RESPONSES[client.meta.service_model.protocol]
+
+        def before_send(event_name, request, **kwargs):
+            if self._random.random() < self.probability_for(event_name.split('.', 1)[1]):
+                return AWSResponse(request.url, status, {'Content-Type': 'text/xml'}, _RawBody(body))
+
+        if self.rules:
+            client.meta.events.register('before-send.*.*', before_send)
+        return client
+
+
+class PipelineBenchmark:
+    """Owns the moto server, the local sshd and a scratch directory (key pair, journal & trace files land in
+    the current directory) for one benchmark session. Scenarios share AWS state so resume & destroy see
+    what setup created."""
+
+    def __init__(self, latency_rules=(), log_dir='', throttle_rules=(), tape=None):
+        self.latency_rules = list(latency_rules)
+        self.throttle_rules = list(throttle_rules)
+        self.tape = tape
+        self.work_dir = log_dir or tempfile.mkdtemp(prefix='madzumo-bench-')
+        self.moto_server = ThreadedMotoServer(ip_address='127.0.0.1', port=0)
+        self.sshd = LocalSSHServer(OPERATOR_SCRIPT)
+        self._saved_environ = {}
+
+    def __enter__(self):
+        os.makedirs(self.work_dir, exist_ok=True)
+        self._original_cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+        self.moto_server.start()
+        host, port = self.moto_server.get_host_and_port()
+        self._set_environ({'MADZUMO_AWS_ENDPOINT_URL': f"http://{host}:{port}",
+                           'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark',
+                           'AWS_DEFAULT_REGION': 'us-east-1'})
+        self.sshd.start()
+        ssh_pool.address_override = self.sshd.address
+        ssh_pool.retry_delay = 0
+        AWSbase.client_hooks.append(LatencyInjector(self.latency_rules))
+        AWSbase.client_hooks.append(ThrottleInjector(self.throttle_rules))
+        cassette.use(self.tape)
+        # the demo is interactive: confirm every prompt and skip screen clears
+        self._original_input, self._original_clear = builtins.input, hc.clear_console
+        builtins.input = lambda prompt='': 'yes'
+        hc.clear_console = lambda: None
+        return self
+
+    def __exit__(self, *exc_info):
+        builtins.input, hc.clear_console = self._original_input, self._original_clear
+        del AWSbase.client_hooks[-2:]
+        cassette.use(None)
+        if self.tape is not None and not self.tape.replaying:
+            self.tape.save()
+        AWSbase.reset_client_registry()
+        ssh_pool.close_all()
+        ssh_pool.address_override = None
+        self.sshd.stop()
+        self.moto_server.stop()
+        for name, value in self._saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        os.chdir(self._original_cwd)
+
+    def _set_environ(self, values):
+        for name, value in values.items():
+            self._saved_environ.setdefault(name, os.environ.get(name))
+            os.environ[name] = value
+
+    @staticmethod
+    def _new_demo(warm_standby=False):
+        from start_demo import StartDemo
+        demo = StartDemo(warm_standby=warm_standby)
+        demo.operator_instance.key_id = os.environ['AWS_ACCESS_KEY_ID']
+        demo.operator_instance.secret_id = os.environ['AWS_SECRET_ACCESS_KEY']
+        return demo
+
+    def run_scenario(self, scenario):
+        # every scenario starts like a fresh process: no pooled SSH connections, no cached boto3 clients
+        ssh_pool.close_all()
+        AWSbase.reset_client_registry()
+        self.sshd.reset_counters()
+        log_path = os.path.join(self.work_dir, f"{scenario}.log")
+        with open(log_path, 'w') as log_file, contextlib.redirect_stdout(log_file):
+            demo = self._new_demo(warm_standby=scenario.startswith('standby-'))
+            start = time.perf_counter()
+            if scenario.endswith('destroy'):
+                demo._destroy_the_show()
+            else:
+                demo._setup_the_show()
+            wall_time = time.perf_counter() - start
+        api_calls = {}
+        for span in tracer.spans:
+            if span.category == 'aws':
+                api_calls[span.name] = api_calls.get(span.name, 0) + 1
+        api_totals = api_metrics.totals()
+        return {'scenario': scenario,
+                'wall_seconds': round(wall_time, 2),
+                'api_calls': sum(api_calls.values()),
+                'api_retries': api_totals['retries'],
+                'api_throttles': api_totals['throttles'],
+                'api_errors': api_totals['errors'],
+                'api_calls_by_operation': dict(sorted(api_calls.items())),
+                'ssh_handshakes': self.sshd.handshakes,
+                'ssh_commands': len(self.sshd.commands),
+                'log': log_path}
+
+
+def compare_to_baseline(results, baseline, tolerance, slack):
+    """Regression messages for every scenario that got slower than tolerance (plus slack seconds, so sub-second
+    scenarios do not trip on noise) or did more remote work"""
+    regressions = []
+    for result in results:
+        reference = baseline.get(result['scenario'])
+        if reference is None:
+            continue
+        if result['wall_seconds'] > reference['wall_seconds'] * (1 + tolerance) + slack:
+            regressions.append(f"{result['scenario']}: wall time {result['wall_seconds']}s "
+                               f"(baseline {reference['wall_seconds']}s)")
+        for metric in ('api_calls', 'ssh_handshakes'):
+            if result[metric] > reference[metric]:
+                regressions.append(f"{result['scenario']}: {metric} {result[metric]} (baseline {reference[metric]})")
+    return regressions
+
+
+def print_report(results, baseline):
+    lines = [f"{'Scenario':<16} {'Wall':>8} {'Baseline':>9} {'API calls':>10} {'SSH handshakes':>15} "
+             f"{'SSH commands':>13} {'Retries':>8}"]
+    for result in results:
+        reference = baseline.get(result['scenario'], {})
+        reference_time = f"{reference['wall_seconds']:.1f}s" if reference else '-'
+        lines.append(f"{result['scenario']:<16} {result['wall_seconds']:7.1f}s {reference_time:>9} "
+                     f"{result['api_calls']:>10} {result['ssh_handshakes']:>15} {result['ssh_commands']:>13} "
+                     f"{result['api_retries']:>8}")
+    hc.console_message(lines, hc.ConsoleColors.info, total_chars=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline setup/teardown benchmark (moto + local sshd)')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='run only these scenarios (the others expect setup to run first)')
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE.OPERATION=SECONDS',
+                        help="delay injected before matching AWS requests, e.g. 'ec2.*=0.1'")
+    parser.add_argument('--throttle', action='append', default=[], metavar='SERVICE.OPERATION=PROBABILITY',
+                        help="share of matching AWS requests answered with a throttling error, e.g. 'ec2.*=0.2'")
+    parser.add_argument('--record', default='', metavar='CASSETTE', help='record AWS calls & SSH commands here')
+    parser.add_argument('--replay', default='', metavar='CASSETTE', help='replay a recorded run instead')
+    parser.add_argument('--replay-latency', action='store_true', help='replay every call at its recorded speed')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed wall time growth (0.25 = 25%%)')
+    parser.add_argument('--slack', type=float, default=0.5, help='allowed wall time growth in seconds on top')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--work-dir', default='', help='keep logs, key pair & traces here')
+    args = parser.parse_args()
+
+    baseline_record = {'scenarios': {}, 'latency': []}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as file:
+            baseline_record = json.load(file)
+    baseline = baseline_record['scenarios']
+
+    tape = None
+    if args.record or args.replay:
+        tape = cassette.Cassette(os.path.abspath(args.replay or args.record), 'replay' if args.replay else 'record',
+                                 args.replay_latency)
+    results = []
+    with PipelineBenchmark(args.latency, args.work_dir, args.throttle, tape) as benchmark:
+        for scenario in args.scenario or SCENARIOS:
+            results.append(benchmark.run_scenario(scenario))
+        hc.console_message([f"Logs & traces: {benchmark.work_dir}"], hc.ConsoleColors.info, total_chars=0)
+
+    print_report(results, baseline)
+    if args.replay:
+        # nothing ran against moto or the sshd, so there is nothing to compare or keep
+        return 0
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    run_record = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'latency': args.latency,
+                  'throttle': args.throttle,
+                  'scenarios': {result['scenario']: {key: value for key, value in result.items()
+                                                     if key not in ('scenario', 'log')}
+                                for result in results}}
+    with open(HISTORY_FILE, 'a') as file:
+        file.write(json.dumps(run_record) + '\n')
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w') as file:
+            json.dump(run_record, file, indent=2)
+        hc.console_message([f"Baseline saved: {BASELINE_FILE}"], hc.ConsoleColors.info, total_chars=0)
+        return 0
+
+    if baseline and (args.latency != baseline_record.get('latency', []) or
+                     args.throttle != baseline_record.get('throttle', [])):
+        hc.console_message(['Latency or throttle rules differ from the baseline, wall times are not comparable'],
+                           hc.ConsoleColors.warning, total_chars=0)
+    regressions = compare_to_baseline(results, baseline, args.tolerance, args.slack)
+    if regressions:
+        hc.console_message(['Regressions'] + regressions, hc.ConsoleColors.error, total_chars=0)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Transport errors through an instrumented boto3 client.
+
+Points an AWSbase client (every client hook attached: tracing, api_metrics, cassette) at a port nothing listens
+on and calls it. The caller must see botocore's EndpointConnectionError, not an error from a hook, and
+api_metrics must count the failed call. Exits 1 otherwise.
+
+    python benchmarks/check_api_metrics.py
+"""
+import os
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import helper_config as hc
+from aws_madzumo import AWSbase
+from api_metrics import api_metrics
+
+# nothing listens on port 1, so connecting fails at once
+UNREACHABLE_ENDPOINT = 'http://127.0.0.1:1'
+
+
+def check_connection_error():
+    """Problems found when a call cannot reach its endpoint"""
+    from botocore.exceptions import EndpointConnectionError
+    aws_base = AWSbase('check', 'check')
+    aws_base.endpoint_url = UNREACHABLE_ENDPOINT
+    api_metrics.reset()
+    problems = []
+    try:
+        aws_base.get_client('sts').get_caller_identity()
+        problems.append('get_caller_identity succeeded against an unreachable endpoint')
+    except EndpointConnectionError:
+        pass
+    except Exception as ex:
+        problems.append(f"expected EndpointConnectionError, the caller got {type(ex).__name__}: {ex}")
+    metrics = api_metrics.operations.get('sts.GetCallerIdentity')
+    if metrics is None or metrics.calls != 1 or metrics.errors != 1:
+        problems.append(f"api_metrics did not count the failed call: {api_metrics.totals()}")
+    return problems
+
+
+def main():
+    # one retry keeps the check fast and still goes through the retry handlers
+    original_retry_config = AWSbase.retry_config
+    AWSbase.retry_config = {'mode': 'standard', 'max_attempts': 2}
+    AWSbase.reset_client_registry()
+    try:
+        problems = check_connection_error()
+    finally:
+        AWSbase.retry_config = original_retry_config
+        AWSbase.reset_client_registry()
+    if problems:
+        hc.console_message(['API metrics check failed'] + problems, hc.ConsoleColors.error, total_chars=0)
+        return 1
+    hc.console_message(['API metrics check passed: connection errors reach the caller and are counted'],
+                       hc.ConsoleColors.info, total_chars=0)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import re
+import socket
+import threading
+import time
+import paramiko
+from ssh_client import STEP_CACHED
+
+
+class ScriptedCommand:
+    """Canned reply for every remote command matching pattern (re.search on the full command text).
+    delay seconds pass before the output is sent, standing in for the real work on the Operator Node."""
+
+    def __init__(self, pattern, stdout='', stderr='', exit_status=0, delay=0.0):
+        self.pattern = re.compile(pattern, re.DOTALL)
+        self.stdout = stdout
+        self.stderr = stderr
+        self.exit_status = exit_status
+        self.delay = delay
+
+
+# the framing of ssh_client.render_batch: every command sits between a start echo and its exit status
+BATCH_MARKER = re.compile(r'^batch_marker=(\S+)$', re.MULTILINE)
+BATCH_COMMAND = re.compile(r'^echo "\$batch_marker (\d+) start"\n\{\n(.*?)\n\} 2>&1\nbatch_status=\$\?\n'
+                           r'echo "\$batch_marker \d+ end \$batch_status"\n(\[ \$batch_status -eq 0 \] \|\| exit)?',
+                           re.MULTILINE | re.DOTALL)
+# ssh_client.render_cached_step: step name & the fingerprint its marker file has to hold
+STEP_GUARD = re.compile(r'^# step (\S+)\nif \[ "\$\(head -n 1 \S+ 2>/dev/null\)" = "([0-9a-f]+)" \]', re.MULTILINE)
+
+
+class _ScriptedServer(paramiko.ServerInterface):
+    def __init__(self, sshd):
+        self.sshd = sshd
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        self.sshd.count_handshake()
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.sshd.run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+class LocalSSHServer:
+    """Throwaway sshd on 127.0.0.1 that accepts any key and answers exec requests from a script instead of a
+    shell. The first matching ScriptedCommand wins, anything unmatched exits 0 with no output. The commands of an
+    SSHClient.run_batch script are answered one by one on the same channel. Cached steps (SSHClient.run_batch with
+    a step_name) remember their fingerprint in step_markers like the marker files on a real node.
+    Counts authenticated handshakes (not bare port probes) & commands so a benchmark can tell connection
+    reuse from reconnects."""
+
+    def __init__(self, script=None, port=0):
+        self.script = list(script or [])
+        self.port = port
+        self.handshakes = 0
+        self.commands = []
+        self.step_markers = {}
+        # paramiko replies to the exec request after check_channel_exec_request returns. A reply that races
+        # the exit status & close kills the client's transport, so nothing is sent before this grace period
+        self.reply_grace = 0.02
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._socket = None
+        self._transports = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    @property
+    def address(self):
+        return '127.0.0.1', self.port
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', self.port))
+        self._socket.listen(50)
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._socket.close()
+        with self._lock:
+            for transport in self._transports:
+                transport.close()
+            self._transports = []
+
+    def reset_counters(self):
+        with self._lock:
+            self.handshakes = 0
+            self.commands = []
+
+    def count_handshake(self):
+        with self._lock:
+            self.handshakes += 1
+
+    def _accept_loop(self):
+        while not self._stopped.is_set():
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self._host_key)
+            with self._lock:
+                self._transports.append(transport)
+            try:
+                transport.start_server(server=_ScriptedServer(self))
+            except (paramiko.SSHException, EOFError):
+                transport.close()
+
+    def _match(self, command):
+        for scripted in self.script:
+            if scripted.pattern.search(command):
+                return scripted
+        return ScriptedCommand('')
+
+    def _run_batch(self, channel, command, marker):
+        """Answer each command of an SSHClient.run_batch script from the script, framed the way the shell would"""
+        exit_status = 0
+        for index, text, stop_on_failure in BATCH_COMMAND.findall(command):
+            scripted = self._match(text)
+            channel.sendall(f"{marker} {index} start\n".encode())
+            time.sleep(scripted.delay)
+            channel.sendall(f"{scripted.stdout}{scripted.stderr}{marker} {index} end {scripted.exit_status}\n".encode())
+            if scripted.exit_status != 0 and stop_on_failure:
+                exit_status = scripted.exit_status
+                break
+        return exit_status
+
+    def run_command(self, channel, command):
+        with self._lock:
+            self.commands.append(command)
+        scripted = self._match(command)
+        batch = BATCH_MARKER.search(command)
+        step = STEP_GUARD.search(command)
+        try:
+            if step and self.step_markers.get(step.group(1)) == step.group(2):
+                time.sleep(self.reply_grace)
+                channel.sendall(f"{STEP_CACHED} {step.group(1)} ok\n".encode())
+                channel.send_exit_status(0)
+                return
+            if batch:
+                time.sleep(self.reply_grace)
+                exit_status = self._run_batch(channel, command, batch.group(1))
+            else:
+                time.sleep(max(scripted.delay, self.reply_grace))
+                if scripted.stdout:
+                    channel.sendall(scripted.stdout.encode())
+                if scripted.stderr:
+                    channel.sendall_stderr(scripted.stderr.encode())
+                exit_status = scripted.exit_status
+            if step and exit_status == 0:
+                self.step_markers[step.group(1)] = step.group(2)
+            channel.send_exit_status(exit_status)
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
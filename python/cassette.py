@@ -0,0 +1,341 @@
+import atexit
+import base64
+import datetime
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import helper_config as hc
+from tracing import tracer
+
+CASSETTE_VERSION = 1
+REDACTED = 'REDACTED'
+# API parameters & response fields that are never written to a cassette
+SECRET_FIELDS = ('SecretAccessKey', 'SessionToken', 'KeyMaterial', 'Password', 'PrivateKey')
+# uploaded content (the pipeline journal holds timings) does not identify a call
+CONTENT_FIELDS = ('Body',)
+# secrets inside shell commands (aws configure on the Operator Node) and their output
+SECRET_PATTERNS = (re.compile(r'(aws_secret_access_key\s+)\S+'), re.compile(r'(aws_session_token\s+)\S+'),
+                   re.compile(r'(AWS_SECRET_ACCESS_KEY=)\S+'), re.compile(r'(AWS_SESSION_TOKEN=)\S+'))
+# private keys are redacted wherever they show up: the key pair backup downloaded from S3, command output, ...
+PRIVATE_KEY = re.compile(r'-----BEGIN [A-Z ]*PRIVATE KEY-----')
+PRIVATE_KEY_END = re.compile(r'-----END [A-Z ]*PRIVATE KEY-----')
+# SSHClient.run_batch frames its output with a marker that is new on every run
+BATCH_MARKER = re.compile(r'MADZUMO_BATCH_[0-9a-f]{12}')
+RECORDED_MARKER = 'MADZUMO_BATCH_RECORDED'
+
+
+class CassetteMiss(Exception):
+    """Replay asked for an interaction that was never recorded"""
+
+
+def redact_text(text):
+    if PRIVATE_KEY.search(text):
+        return REDACTED
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(rf"\g<1>{REDACTED}", text)
+    return text
+
+
+def _encode(value):
+    """JSON-safe copy of a parsed boto3 response or parameters, secrets replaced"""
+    if isinstance(value, dict):
+        return {key: REDACTED if key in SECRET_FIELDS else _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        if PRIVATE_KEY.search(value.decode('latin-1')):
+            value = REDACTED.encode()  # replayed as the object's content
+        return {'__bytes__': base64.b64encode(value).decode()}
+    if isinstance(value, str) and PRIVATE_KEY.search(value):
+        return REDACTED
+    if hasattr(value, 'read'):  # StreamingBody, read by _read_streams before recording
+        return {'__bytes__': ''}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.datetime.fromisoformat(value['__datetime__'])
+        if '__bytes__' in value:
+            return base64.b64decode(value['__bytes__'])
+        if '__stream__' in value:
+            from botocore.response import StreamingBody
+            import io
+            content = base64.b64decode(value['__stream__'])
+            return StreamingBody(io.BytesIO(content), len(content))
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def leaked_secrets(value, path='interactions'):
+    """Where a secret got past redaction: private keys (in text or base64 content) & unredacted secret fields"""
+    leaks = []
+    if isinstance(value, dict):
+        content = value.get('__bytes__', value.get('__stream__'))
+        if content is not None:
+            if PRIVATE_KEY.search(base64.b64decode(content).decode('latin-1')):
+                leaks.append(f"{path}: private key")
+            return leaks
+        for key, item in value.items():
+            if key in SECRET_FIELDS and item != REDACTED:
+                leaks.append(f"{path}.{key}: {key}")
+            else:
+                leaks += leaked_secrets(item, f"{path}.{key}")
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            leaks += leaked_secrets(item, f"{path}[{index}]")
+    elif isinstance(value, str) and PRIVATE_KEY.search(value):
+        leaks.append(f"{path}: private key")
+    return leaks
+
+
+def _read_streams(parsed):
+    """Replace StreamingBody values (s3 get_object) with readable copies, returning {field: bytes}"""
+    from botocore.response import StreamingBody
+    import io
+    contents = {}
+    for key, value in parsed.items():
+        if isinstance(value, StreamingBody):
+            contents[key] = value.read()
+            parsed[key] = StreamingBody(io.BytesIO(contents[key]), len(contents[key]))
+    return contents
+
+
+class _ReplayedHttpResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+
+class Cassette:
+    """Records AWS API calls, SSH commands and SSH reachability probes to a file, or replays them from it without
+    touching AWS or the Operator Node. Chosen with environment variables, read on first use:
+
+        MADZUMO_CASSETTE=status.json.gz MADZUMO_CASSETTE_MODE=record python start_demo.py
+        MADZUMO_CASSETTE=status.json.gz python start_demo.py
+        MADZUMO_CASSETTE=status.json.gz MADZUMO_CASSETTE_LATENCY=1 python start_demo.py
+
+    Interactions are matched on what was asked (operation & parameters, host & command) and replayed in the order
+    they were recorded, the last one repeating once they run out, so polling loops see the same progression.
+    Replay is instant unless latency is set, then every call takes as long as it did when recorded.
+    Secrets in parameters, responses and commands are redacted before anything is written. A .gz path is
+    gzip compressed."""
+
+    def __init__(self, path, mode='replay', latency=False):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode '{mode}' (use record or replay)")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.interactions = []
+        self._replay = {}  # {(kind, key): [interactions]}
+        self._position = {}
+        self._lock = threading.Lock()
+        if mode == 'replay':
+            self.load()
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def _open(self, file_mode):
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, file_mode + 't', encoding='utf-8')
+        return open(self.path, file_mode, encoding='utf-8')
+
+    def load(self):
+        with self._open('r') as file:
+            content = json.load(file)
+        if content.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"{self.path} is a version {content.get('version')} cassette, "
+                             f"expected {CASSETTE_VERSION}")
+        self.interactions = content['interactions']
+        for interaction in self.interactions:
+            self._replay.setdefault((interaction['kind'], interaction['key']), []).append(interaction)
+
+    def save(self):
+        """Write the recording. Refused (False) if a secret got past redaction, nothing is written then"""
+        with self._lock:
+            interactions = list(self.interactions)
+        leaks = leaked_secrets(interactions)
+        if leaks:
+            hc.console_message([f"Cassette not saved, it would contain secrets: {self.path}"] + leaks[:10],
+                               hc.ConsoleColors.error, total_chars=0)
+            return False
+        with self._open('w') as file:
+            json.dump({'version': CASSETTE_VERSION, 'recorded': hc.get_current_time(),
+                       'interactions': interactions}, file, separators=(',', ':'))
+        hc.console_message([f"Cassette saved: {self.path} ({len(interactions)} interactions)"],
+                           hc.ConsoleColors.info)
+        return True
+
+    def _record(self, kind, key, seconds, **fields):
+        with self._lock:
+            self.interactions.append(dict(kind=kind, key=key, seconds=round(seconds, 3), **fields))
+
+    def _next(self, kind, key):
+        with self._lock:
+            recorded = self._replay.get((kind, key))
+            if not recorded:
+                raise CassetteMiss(f"{self.path} has no recorded {kind} interaction for {key[:200]}")
+            position = self._position.get((kind, key), 0)
+            self._position[(kind, key)] = position + 1
+        return recorded[min(position, len(recorded) - 1)]
+
+    def _pause(self, seconds):
+        if self.latency and seconds > 0:
+            time.sleep(seconds)
+
+    def idle_time(self, seconds):
+        """How long a polling loop should actually wait: nothing changes between replayed polls"""
+        return seconds if not self.replaying or self.latency else 0
+
+    # AWS: handlers on every boto3 client, see instrument()
+
+    @staticmethod
+    def _aws_key(model, params):
+        params = {key: '' if key in CONTENT_FIELDS else value for key, value in params.items()}
+        return (f"{model.service_model.service_name}.{model.name} "
+                f"{json.dumps(_encode(params), sort_keys=True, default=str)}")
+
+    def provide_client_params(self, params, model, context, **kwargs):
+        # parameters as the caller passed them, before botocore adds idempotency tokens
+        context['madzumo_cassette_key'] = self._aws_key(model, params)
+        context['madzumo_cassette_start'] = time.monotonic()
+
+    def before_call(self, model, context, **kwargs):
+        if not self.replaying:
+            return None
+        interaction = self._next('aws', context['madzumo_cassette_key'])
+        self._pause(interaction['seconds'])
+        return _ReplayedHttpResponse(interaction['status']), _decode(interaction['response'])
+
+    def after_call(self, http_response, parsed, model, context, **kwargs):
+        if self.replaying or 'madzumo_cassette_key' not in context:
+            return
+        streams = _read_streams(parsed)
+        response = _encode(dict(parsed, **streams))
+        for key in streams:
+            response[key] = {'__stream__': response[key]['__bytes__']}  # replayed as a StreamingBody again
+        response.get('ResponseMetadata', {}).pop('HTTPHeaders', None)  # bulky and nothing reads them
+        self._record('aws', context['madzumo_cassette_key'],
+                     time.monotonic() - context['madzumo_cassette_start'],
+                     status=http_response.status_code, response=response)
+
+    # SSH
+
+    def stream_command(self, ssh_client, execute_command, run):
+        """SSHClient.stream_command through the cassette. run is the live stream_command"""
+        marker = BATCH_MARKER.search(execute_command)
+        key = f"{ssh_client.hostname}\n{redact_text(BATCH_MARKER.sub(RECORDED_MARKER, execute_command))}"
+        if not self.replaying:
+            lines = []
+            start_time = time.monotonic()
+            in_private_key = False
+            for stream_name, line in run(execute_command):
+                # a printed private key is redacted from its BEGIN line through its END line
+                in_private_key = in_private_key or bool(PRIVATE_KEY.search(line))
+                if in_private_key:
+                    recorded_line = REDACTED
+                    in_private_key = not PRIVATE_KEY_END.search(line)
+                else:
+                    recorded_line = redact_text(line.replace(marker.group(), RECORDED_MARKER) if marker else line)
+                lines.append([round(time.monotonic() - start_time, 3), stream_name, recorded_line])
+                yield stream_name, line
+            self._record('ssh', key, ssh_client.command_duration, exit_status=ssh_client.exit_status,
+                         lines=lines)
+            return
+        interaction = self._next('ssh', key)
+        ssh_client.shell_command = execute_command
+        start_time = time.monotonic()
+        trace_start = tracer.now()
+        for offset, stream_name, line in interaction['lines']:
+            self._pause(offset - (time.monotonic() - start_time))
+            yield stream_name, line.replace(RECORDED_MARKER, marker.group()) if marker else line
+        self._pause(interaction['seconds'] - (time.monotonic() - start_time))
+        ssh_client.exit_status = interaction['exit_status']
+        ssh_client.command_duration = time.monotonic() - start_time
+        tracer.add_span(ssh_client._trace_name(), 'ssh', trace_start, tracer.now(),
+                        {'exit_status': ssh_client.exit_status, 'host': ssh_client.hostname, 'cassette': True})
+
+    def call(self, kind, key, function):
+        """Result of function() (JSON-safe), recorded or replayed. For file syncs & reachability probes"""
+        if not self.replaying:
+            start_time = time.monotonic()
+            result = function()
+            self._record(kind, key, time.monotonic() - start_time, result=result)
+            return result
+        interaction = self._next(kind, key)
+        self._pause(interaction['seconds'])
+        return interaction['result']
+
+
+_current = None
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def current():
+    """The process' cassette, from MADZUMO_CASSETTE on first use. None when there is none"""
+    global _current, _configured
+    if not _configured:
+        with _configure_lock:
+            if not _configured:
+                path = os.environ.get('MADZUMO_CASSETTE', '')
+                if path:
+                    _current = Cassette(path, os.environ.get('MADZUMO_CASSETTE_MODE', 'replay'),
+                                        os.environ.get('MADZUMO_CASSETTE_LATENCY', '') not in ('', '0'))
+                    hc.console_message([f"Cassette {_current.mode}: {path}"], hc.ConsoleColors.warning)
+                    if not _current.replaying:
+                        atexit.register(_current.save)
+                _configured = True
+    return _current
+
+
+def use(cassette):
+    """Make cassette (or None) the process' cassette instead of the environment's"""
+    global _current, _configured
+    with _configure_lock:
+        _current = cassette
+        _configured = True
+
+
+def idle_time(seconds):
+    cassette = current()
+    return cassette.idle_time(seconds) if cassette is not None else seconds
+
+
+def _provide_client_params(**kwargs):
+    cassette = current()
+    if cassette is not None:
+        cassette.provide_client_params(**kwargs)
+
+
+def _before_call(**kwargs):
+    cassette = current()
+    if cassette is not None:
+        return cassette.before_call(**kwargs)
+    return None
+
+
+def _after_call(**kwargs):
+    cassette = current()
+    if cassette is not None:
+        cassette.after_call(**kwargs)
+
+
+def instrument(client):
+    """Route the client's API calls through the process' cassette, whenever there is one"""
+    client.meta.events.register('provide-client-params.*.*', _provide_client_params)
+    client.meta.events.register('before-call.*.*', _before_call)
+    client.meta.events.register('after-call.*.*', _after_call)
+    return client
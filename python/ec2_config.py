@@ -1,16 +1,23 @@
 import aws_madzumo
+import asyncio
 import helper_config as hc
-import boto3
 import os
-from time import sleep
+import textwrap
+from async_core import aws_executor, run_blocking, run_sync
+from instance_waiter import InstanceWaiter
+from aws_inventory import ResourceInventory
+from tracing import tracer
 import s3_config
+from ssh_client import ssh_pool
+
+# written by the user-data bootstrap: its output, then its exit status once it has finished
+BOOTSTRAP_LOG = '/var/log/madzumo-bootstrap.log'
+BOOTSTRAP_STATUS = '/var/log/madzumo-bootstrap.status'
 
 
 class Ec2Config(aws_madzumo.AWSbase):
     def __init__(self, instance_name, key_id='', secret_id='', region='us-east-1'):
         super().__init__(key_id, secret_id, region)
-        self.ec2_client = boto3.client('ec2', region_name=region)
-        self.ec2_resource = boto3.resource('ec2', region_name=region)
         self.ec2_instance_name = instance_name
         self.ec2_instance_public_ip = ''
         self.ec2_instance_private_ip = ''
@@ -23,18 +30,35 @@ class Ec2Config(aws_madzumo.AWSbase):
         self.s3_temp_bucket = ''
         self.ssh_username = 'ec2-user'
         self.ssh_timeout = 60
+        self.instance_wait_timings = {}
+        # bootstrap script passed as user-data to new instances (render_user_data), it runs while they boot
+        self.user_data = ''
+        # stop the instance on teardown and start it again on setup instead of terminate & create
+        self.warm_standby = False
+        self.inventory = ResourceInventory(lambda: self.ec2_client, self.tag_identity_key, self.tag_identity_value)
+
+    @property
+    def ec2_client(self):
+        return self.get_client('ec2')
+
+    @property
+    def ec2_resource(self):
+        return self.get_resource('ec2')
 
     def create_ec2_instance(self, backup_key_to_s3=False):
-        """Creates Instance in Default VPC. Instance Name required."""
+        """Creates Instance in Default VPC. Instance Name required. Returns True once the instance is running."""
         if self.get_instance():
             hc.console_message(["EC2 instance already present"], hc.ConsoleColors.info)
-            self.populate_ec2_instance()
+            return self.populate_ec2_instance()
+        elif self.get_stopped_instance():
+            return self.start_ec2_instance()
         else:
             self.create_security_group()
             self.create_ec2_key_pair()
             if backup_key_to_s3:
                 self.upload_key_pair()
             try:  # Launch a new EC2 instance
+                launch_options = {'UserData': self.user_data} if self.user_data else {}
                 results = self.ec2_resource.create_instances(
                     ImageId=self.instance_ami,
                     MinCount=1,
@@ -57,17 +81,83 @@ class Ec2Config(aws_madzumo.AWSbase):
                                 }
                             ]
                         }
-                    ]
+                    ],
+                    **launch_options
                 )[0].id
+                self.inventory.invalidate('instances')
                 hc.console_message([f"EC2 Instance Created:{self.ec2_instance_name}"], hc.ConsoleColors.info)
                 self.ec2_instance_id = results
             except Exception as ex:
                 hc.console_message([f"Error creating Instance:{ex}"], hc.ConsoleColors.error)
-                return
+                return False
 
-            self.wait_for_instance_to_load()
-            self.populate_ec2_instance()
+            ready = self.wait_for_instance_to_load()
+            self.inventory.invalidate('instances')  # state & IPs changed while booting
+            if not ready:
+                return False
+            if not self.populate_ec2_instance():
+                return False
             print(f"EC2 Instance Ready. IP: {self.ec2_instance_public_ip}")
+            return True
+
+    def start_ec2_instance(self):
+        """Start the stopped (warm standby) instance and populate its details. It comes back with a new public IP,
+        its disk still holds everything installed before it was stopped."""
+        instance = self.get_stopped_instance()[0]['Instances'][0]
+        self.ec2_instance_id = instance['InstanceId']
+        hc.console_message([f"Starting warm standby instance: {self.ec2_instance_name}"], hc.ConsoleColors.info)
+        try:
+            if instance['State']['Name'] == 'stopping':
+                InstanceWaiter(self.ec2_client, self.ec2_instance_id).wait_for_state('stopped')
+            self.ec2_client.start_instances(InstanceIds=[self.ec2_instance_id])
+            self.inventory.invalidate('instances')
+        except Exception as ex:
+            hc.console_message([f"Error starting Instance:{ex}"], hc.ConsoleColors.error)
+            return False
+
+        ready = self.wait_for_instance_to_load()
+        self.inventory.invalidate('instances')
+        if not ready:
+            return False
+        if not self.populate_ec2_instance():
+            return False
+        print(f"EC2 Instance Ready. IP: {self.ec2_instance_public_ip}")
+        return True
+
+    def stop_ec2_instance(self):
+        """Warm standby teardown: stop the instance instead of terminating it. Tools, checkout & caches stay on its
+        disk, the key pair & security group stay for the next start. Returns True once it is stopped."""
+        if not self.populate_ec2_instance(False):
+            return bool(self.get_stopped_instance())
+        hc.console_message(["Stopping Operator Node (warm standby)"], hc.ConsoleColors.info)
+        try:
+            self.ec2_client.stop_instances(InstanceIds=[self.ec2_instance_id])
+        except Exception as ex:
+            hc.console_message([f"Error stopping Instance:{ex}"], hc.ConsoleColors.error)
+            return False
+        self.inventory.invalidate('instances')
+        # the public IP is released, so the pooled connection is of no use any more
+        ssh_pool.discard(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
+        waiter = InstanceWaiter(self.ec2_client, self.ec2_instance_id)
+        with tracer.span('wait for instance stopped', 'wait', instance=self.ec2_instance_id):
+            stopped = waiter.wait_for_state('stopped')
+        self.inventory.invalidate('instances')
+        return stopped
+
+    def render_user_data(self, commands):
+        """User-data script that runs the commands as ssh_username, one after another, stopping at the first
+        failure. Output goes to BOOTSTRAP_LOG and the exit status to BOOTSTRAP_STATUS when it is done, for
+        SSHClient.wait_for_bootstrap. Do not put secrets in here: user-data can be read back from the instance."""
+        script = '\n'.join(['set -ex'] + [textwrap.dedent(command).strip('\n') for command in commands])
+        return '\n'.join([
+            '#!/bin/bash',
+            f"touch {BOOTSTRAP_LOG} && chmod 644 {BOOTSTRAP_LOG}",
+            f"runuser -l {self.ssh_username} -c 'bash -s' > {BOOTSTRAP_LOG} 2>&1 <<'MADZUMO_BOOTSTRAP'",
+            script,
+            'MADZUMO_BOOTSTRAP',
+            # written aside and renamed, so wait_for_bootstrap never reads a status file that is still empty
+            f"echo $? > {BOOTSTRAP_STATUS}.tmp && mv {BOOTSTRAP_STATUS}.tmp {BOOTSTRAP_STATUS}",
+        ]) + '\n'
 
     def populate_ec2_instance(self, show_result=True):
         """Populate all variables with Instance Information"""
@@ -108,6 +198,7 @@ class Ec2Config(aws_madzumo.AWSbase):
                 for instance in reservation['Instances']:
                     you_are_terminated = self.ec2_resource.Instance(instance['InstanceId'])
                     you_are_terminated.terminate()
+                    self.inventory.invalidate('instances')
                     print(f"EC2 instance {instance['InstanceId']} terminated.\n Waiting for completion...")
                     # time.sleep(10)
         else:
@@ -120,25 +211,31 @@ class Ec2Config(aws_madzumo.AWSbase):
             if self.ec2_instance_id == '':
                 print("Error: EC2 instance id needed")
             else:
-                hc.console_message(["Terminating Operator Node"], hc.ConsoleColors.info)
-                you_are_terminated = self.ec2_resource.Instance(self.ec2_instance_id)
-                you_are_terminated.terminate()
-                print(f"EC2 instance {self.ec2_instance_id} terminating.....")
-                self.wait_for_instance_to_terminate()
-                self.delete_key_pair()
-                self.delete_security_group()
+                run_sync(self.delete_ec2_instance_async())
+        elif self.get_stopped_instance():
+            # a warm standby node that is no longer wanted
+            self.ec2_instance_id = self.get_stopped_instance()[0]['Instances'][0]['InstanceId']
+            run_sync(self.delete_ec2_instance_async())
+
+    async def delete_ec2_instance_async(self):
+        """Terminate the instance. The key pair is deleted while it shuts down,
+        the security group once it is gone (AWS refuses while an instance still uses it)"""
+        hc.console_message(["Terminating Operator Node"], hc.ConsoleColors.info)
+        await self.async_api.call('ec2', 'terminate_instances', InstanceIds=[self.ec2_instance_id])
+        self.inventory.invalidate('instances')
+        ssh_pool.discard(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
+        print(f"EC2 instance {self.ec2_instance_id} terminating.....")
+
+        async def remove_security_group():
+            await run_blocking(aws_executor, self.wait_for_instance_to_terminate)
+            await run_blocking(aws_executor, self.delete_security_group)
+
+        await asyncio.gather(remove_security_group(), run_blocking(aws_executor, self.delete_key_pair))
 
     def get_security_group_id(self):
-        response = self.ec2_client.describe_security_groups(
-            Filters=[
-                {
-                    'Name': 'tag:Name',
-                    'Values': [f"{self.ec2_instance_name}-sg"]
-                }
-            ]
-        )
-        if response['SecurityGroups']:
-            return response['SecurityGroups'][0]['GroupId']
+        security_group = self.inventory.security_group(f"{self.ec2_instance_name}-sg")
+        if security_group:
+            return security_group['GroupId']
         else:
             return
 
@@ -147,6 +244,7 @@ class Ec2Config(aws_madzumo.AWSbase):
             this_sg_id = self.get_security_group_id()
             you_are_terminated = self.ec2_resource.SecurityGroup(this_sg_id)
             you_are_terminated.delete()
+            self.inventory.invalidate('security_groups')
             hc.console_message([f"Security Group {this_sg_id} terminated."], hc.ConsoleColors.info)
         except Exception as ex:
             print(f"{ex}")
@@ -175,6 +273,7 @@ class Ec2Config(aws_madzumo.AWSbase):
                     }
                 ]
             )
+            self.inventory.invalidate('security_groups')
 
             self.ec2_client.authorize_security_group_ingress(
                 GroupId=sg_madzumo['GroupId'],
@@ -209,22 +308,16 @@ class Ec2Config(aws_madzumo.AWSbase):
                                hc.ConsoleColors.info)
 
     def get_key_pair_id(self):
-        response = self.ec2_client.describe_key_pairs(
-            Filters=[
-                {
-                    'Name': 'key-name',
-                    'Values': [f"{self.ec2_instance_name}-keypair"]
-                }
-            ]
-        )
-        if response['KeyPairs']:
-            return response['KeyPairs'][0]['KeyPairId']
+        key_pair = self.inventory.key_pair(f"{self.ec2_instance_name}-keypair")
+        if key_pair:
+            return key_pair['KeyPairId']
         else:
             return
 
     def delete_key_pair(self):
         key_pair = self.ec2_resource.KeyPair(f"{self.ec2_instance_name}-keypair")
         key_pair.delete()
+        self.inventory.invalidate('key_pairs')
 
         # self.ec2_resource.KeyPair.delete(key_pair_id=key_pair_id)
 
@@ -236,6 +329,7 @@ class Ec2Config(aws_madzumo.AWSbase):
         else:
             try:
                 response = self.ec2_client.create_key_pair(KeyName=f"{self.ec2_instance_name}-keypair")
+                self.inventory.invalidate('key_pairs')
                 # self.ssh_key_material = response['KeyMaterial']
                 key_material = response['KeyMaterial']
                 with open(f"{self.ec2_instance_name}-keypair", 'w') as file:
@@ -249,83 +343,46 @@ class Ec2Config(aws_madzumo.AWSbase):
                 hc.console_message([f"Error creating key pair:", f"{ex}"], hc.ConsoleColors.error)
 
     def get_instance(self):
-        response = self.ec2_client.describe_instances(
-            Filters=[
-                {
-                    'Name': 'tag:Name',
-                    'Values': [self.ec2_instance_name]
-                },
-                {
-                    'Name': 'instance-state-name',
-                    'Values': ['running']
-                }
-            ]
-        )
-        return response['Reservations']
+        """Running instance with this name, shaped like describe_instances Reservations"""
+        return [{'Instances': [instance]}
+                for instance in self.inventory.instances(self.ec2_instance_name, states=['running'])]
+
+    def get_stopped_instance(self):
+        """Stopped (warm standby) instance with this name, shaped like describe_instances Reservations"""
+        return [{'Instances': [instance]}
+                for instance in self.inventory.instances(self.ec2_instance_name, states=['stopped', 'stopping'])]
 
     def get_instance_id(self):
-        response = self.ec2_client.describe_instances(
-            Filters=[
-                {
-                    'Name': 'tag:Name',
-                    'Values': [self.ec2_instance_name]
-                }
-            ]
-        )
-        if response['Reservations']:
-            return response['Reservations'][0]['Instances'][0]['InstanceId']
+        instances = self.inventory.instances(self.ec2_instance_name)
+        if instances:
+            return instances[0]['InstanceId']
         else:
             return
 
     def get_all_instances_tag(self):
-        response = self.ec2_client.describe_instances(
-            Filters=[
-                {
-                    'Name': f'tag:{self.tag_identity_key}',
-                    'Values': [self.tag_identity_value]
-                }
-            ]
-        )
-        return response
+        instances = self.inventory.instances()
+        return {'Reservations': [{'Instances': instances}] if instances else []}
 
     def get_default_vpc_id(self):
-        response = self.ec2_client.describe_vpcs(
-            Filters=[
-                {
-                    'Name': 'is-default',
-                    'Values': ['true']
-                }
-            ]
-        )
-        return response['Vpcs'][0]['VpcId']
+        return self.inventory.default_vpc_id()
 
     def wait_for_instance_to_load(self):
-        """Waits until Instance State = running and Instance Status = passed. Have Instance ID assigned."""
-        while True:
-            hc.console_message([f"{hc.get_current_time()} Waiting for instance to initialize....."],
-                               hc.ConsoleColors.basic)
-            sleep(20)
-            new_response = self.ec2_client.describe_instance_status(InstanceIds=[self.ec2_instance_id])
-            if new_response['InstanceStatuses']:
-                instance_state = new_response['InstanceStatuses'][0]['InstanceState']['Name']
-                instance_status = new_response['InstanceStatuses'][0]['InstanceStatus']['Details'][0]['Status']
-                if instance_state == 'running' and instance_status == 'passed':
-                    break
+        """Waits until Instance State = running and sshd accepts connections. Have Instance ID assigned."""
+        waiter = InstanceWaiter(self.ec2_client, self.ec2_instance_id)
+        with tracer.span('wait for instance ssh', 'wait', instance=self.ec2_instance_id):
+            ready = waiter.wait_for_ssh(address=ssh_pool.address_override)
+        self.instance_wait_timings = waiter.phase_timings
+        return ready
 
     def wait_for_instance_to_terminate(self):
-        """Waits until Instance State = running and Instance Status = passed. Have Instance ID assigned."""
-        while True:
-            response = self.ec2_client.describe_instances(InstanceIds=[self.ec2_instance_id])
-            state = response['Reservations'][0]['Instances'][0]['State']['Name']
-            if state == 'terminated':
-                hc.console_message([f"Instance: {self.ec2_instance_id} terminated."],
-                                   hc.ConsoleColors.info)
-                break
-            else:
-                hc.console_message(
-                    [f"{hc.get_current_time()} Waiting for instance:{self.ec2_instance_id} to Terminate....."],
-                    hc.ConsoleColors.basic)
-                sleep(20)
+        """Waits until Instance State = terminated. Have Instance ID assigned."""
+        waiter = InstanceWaiter(self.ec2_client, self.ec2_instance_id)
+        with tracer.span('wait for instance terminated', 'wait', instance=self.ec2_instance_id):
+            terminated = waiter.wait_for_state('terminated')
+        self.instance_wait_timings = waiter.phase_timings
+        if terminated:
+            hc.console_message([f"Instance: {self.ec2_instance_id} terminated."], hc.ConsoleColors.info)
+        return terminated
 
     def download_key_pair(self):
         try:
@@ -372,12 +429,5 @@ class Ec2Config(aws_madzumo.AWSbase):
             hc.console_message(['Error removing key pair', f"{e}"], hc.ConsoleColors.info)
 
     def reset_ec2_boto3_objects(self):
-        # self.ec2_client = boto3.client('ec2', region_name=self.region)
-        # self.ec2_resource = boto3.resource('ec2', region_name=self.region)
-        session = boto3.Session(
-            aws_access_key_id=self.key_id,
-            aws_secret_access_key=self.secret_id,
-            region_name=self.region  # Optional, but often necessary
-        )
-        self.ec2_client = session.client('ec2')
-        self.ec2_resource = session.resource('ec2')
+        """Clients come from the shared registry keyed by credentials, so only cached lookups need dropping"""
+        self.inventory.invalidate()
@@ -0,0 +1,132 @@
+import atexit
+import base64
+import os
+import tempfile
+import threading
+import time
+import cassette
+import k8s_readiness
+from tracing import tracer
+
+TOKEN_PREFIX = 'k8s-aws-v1.'
+# EKS accepts a token for 15 minutes after it was signed. Sign a new one a minute before that
+TOKEN_LIFETIME = 14 * 60
+# after a failed check the API server is assumed unreachable for this long
+UNAVAILABLE_RETRY = 60
+
+
+def load_balancer_hostname(service):
+    load_balancer = service.status.load_balancer if service.status else None
+    ingress = (load_balancer.ingress or []) if load_balancer else []
+    return (ingress[0].hostname or '') if ingress else ''
+
+
+class EksApiClient:
+    """Kubernetes API of an EKS cluster, called straight from this machine instead of kubectl on the Operator
+    Node. Endpoint & CA come from describe_cluster and the bearer token is a presigned STS GetCallerIdentity URL
+    (what `aws eks get-token` returns), signed locally and cached until it expires. Every request goes through
+    one kubernetes ApiClient, so the TLS connection to the API server is pooled and reused."""
+
+    def __init__(self, aws_base, cluster_name):
+        self.aws_base = aws_base
+        self.cluster_name = cluster_name
+        self._api_client = None
+        self._available = False
+        self._checked_at = None
+        self._token = ''
+        self._token_expiry = 0.0
+        self._lock = threading.Lock()
+        self._client_lock = threading.Lock()
+        self._check_lock = threading.Lock()
+
+    def bearer_token(self):
+        with self._lock:
+            if time.monotonic() >= self._token_expiry:
+                self._token = self._sign_token()
+                self._token_expiry = time.monotonic() + TOKEN_LIFETIME
+            return self._token
+
+    def _sign_token(self):
+        from botocore.signers import RequestSigner
+        sts = self.aws_base.get_client('sts')
+        signer = RequestSigner(sts.meta.service_model.service_id, self.aws_base.region, 'sts', 'v4',
+                               self.aws_base.get_credentials(), sts.meta.events)
+        request = {
+            'method': 'GET',
+            'url': f"{sts.meta.endpoint_url}/?Action=GetCallerIdentity&Version=2011-06-15",
+            'body': {},
+            'headers': {'x-k8s-aws-id': self.cluster_name},
+            'context': {},
+        }
+        url = signer.generate_presigned_url(request, operation_name='', expires_in=60,
+                                            region_name=self.aws_base.region)
+        return TOKEN_PREFIX + base64.urlsafe_b64encode(url.encode()).decode().rstrip('=')
+
+    @property
+    def api_client(self):
+        """kubernetes ApiClient for the cluster. Built on first use from a single describe_cluster call"""
+        with self._client_lock:
+            if self._api_client is None:
+                self._api_client = self._build_api_client()
+        return self._api_client
+
+    def _build_api_client(self):
+        from kubernetes import client
+        cluster = self.aws_base.get_client('eks').describe_cluster(name=self.cluster_name)['cluster']
+        # the kubernetes client wants the CA as a file
+        with tempfile.NamedTemporaryFile('wb', suffix='.crt', delete=False) as ca_file:
+            ca_file.write(base64.b64decode(cluster['certificateAuthority']['data']))
+        atexit.register(os.remove, ca_file.name)
+        configuration = client.Configuration()
+        configuration.host = cluster['endpoint']
+        configuration.ssl_ca_cert = ca_file.name
+        configuration.api_key['authorization'] = self.bearer_token()
+        configuration.api_key_prefix['authorization'] = 'Bearer'
+        # called before every request, so a long watch keeps working once the first token expires
+        configuration.refresh_api_key_hook = self._refresh_token
+        return client.ApiClient(configuration)
+
+    def reset(self):
+        """Forget the cluster (after it was destroyed), the next call describes it again"""
+        with self._client_lock:
+            self._api_client = None
+            self._available = False
+            self._checked_at = None
+
+    def _refresh_token(self, configuration):
+        configuration.api_key['authorization'] = self.bearer_token()
+
+    def available(self):
+        """True when the API server answers from here. It may not: the cluster may not exist yet, or the
+        endpoint may not be reachable from this network, and then callers fall back to kubectl over SSH.
+        A failed check is repeated after UNAVAILABLE_RETRY seconds (the cluster may have been created since).
+        Never while a cassette records or replays: Kubernetes API calls are not on it, kubectl over SSH is"""
+        if cassette.current() is not None:
+            return False
+        with self._check_lock:  # steps running side by side share one check
+            if self._available or (self._checked_at is not None and
+                                   time.monotonic() - self._checked_at < UNAVAILABLE_RETRY):
+                return self._available
+            try:
+                from kubernetes import client
+                with tracer.span('k8s /version', 'k8s'):
+                    client.VersionApi(self.api_client).get_code(_request_timeout=5)
+                self._available = True
+            except Exception:
+                self._available = False
+            self._checked_at = time.monotonic()
+            return self._available
+
+    def service_hostnames(self):
+        """{(namespace, service name): load balancer hostname} for every service in the cluster"""
+        from kubernetes import client
+        with tracer.span('k8s list services', 'k8s'):
+            services = client.CoreV1Api(self.api_client).list_service_for_all_namespaces()
+        return {(service.metadata.namespace, service.metadata.name): load_balancer_hostname(service)
+                for service in services.items}
+
+    def watch_readiness(self, targets, timeout=900, on_ready=None):
+        """Run k8s_readiness.ReadinessWatcher here against the cluster. Returns (all ready, the watcher)"""
+        watcher = k8s_readiness.ReadinessWatcher(self.api_client, [k8s_readiness.ReadinessTarget.parse(target)
+                                                                   for target in targets], timeout)
+        return watcher.run(on_ready), watcher
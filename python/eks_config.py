@@ -1,5 +1,3 @@
-import boto3
-
 from aws_madzumo import AWSbase
 
 
@@ -12,7 +10,7 @@ class Eksconfig(AWSbase):
 
     def create_eks_cluster(self):
         # Create an EKS client
-        eks = boto3.client('eks')
+        eks = self.get_client('eks')
 
         # Create the EKS cluster
         response = eks.create_cluster(
@@ -39,7 +37,7 @@ class Eksconfig(AWSbase):
         print('yes')
 
     def create_node_group(self):
-        ec2 = boto3.client('eks')
+        ec2 = self.get_client('eks')
         ec2.create_nodegroup(
             clusterName=self.cluster_name,
             nodegroupName=f"{self.cluster_name}-nodegroup",
@@ -64,7 +62,7 @@ class Eksconfig(AWSbase):
         print("Node Group created")
 
     def create_eks_role(self):
-        iam_client = boto3.client('iam')
+        iam_client = self.get_client('iam')
 
         # Define the trust relationship policy as a string
         trust_policy = """{
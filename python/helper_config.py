@@ -1,4 +1,3 @@
-import pytz
 import datetime
 from colorama import Fore, Back, Style
 from enum import Enum
@@ -70,6 +69,7 @@ header_art_status = r"""
 
 
 def get_current_time():
+    import pytz  # first use only, keeps it out of startup
     eastern = pytz.timezone('America/New_York')
     current_time = datetime.datetime.now(eastern)
     military_time = current_time.strftime('%H:%M:%S')
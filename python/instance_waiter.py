@@ -0,0 +1,159 @@
+import socket
+import threading
+import time
+import cassette
+import helper_config as hc
+
+
+def probe_ssh(host, port=22, timeout=3):
+    """True once sshd on host answers with its SSH banner. A bare TCP accept is not enough on a booting node."""
+    tape = cassette.current()
+    if tape is not None:
+        return tape.call('probe', host, lambda: _probe_ssh(host, port, timeout))
+    return _probe_ssh(host, port, timeout)
+
+
+def _probe_ssh(host, port, timeout):
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            return sock.recv(4) == b'SSH-'
+    except OSError:
+        return False
+
+
+class InstanceWaiter:
+    """Event driven waits for one EC2 instance.
+    API polls start fast and back off (initial_delay * backoff, capped at max_delay) so short waits return in
+    seconds and long waits do not hammer the API. While the instance boots, port 22 is probed on its own
+    thread and the wait returns the moment sshd answers. Time spent in each phase is kept in phase_timings."""
+
+    def __init__(self, ec2_client, instance_id, initial_delay=2, max_delay=15, backoff=1.5, timeout=900):
+        self.ec2_client = ec2_client
+        self.instance_id = instance_id
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.phase_timings = {}
+        self._start_time = 0.0
+        self._phase_start = 0.0
+
+    def _delays(self):
+        delay = self.initial_delay
+        while True:
+            yield cassette.idle_time(delay)
+            delay = min(delay * self.backoff, self.max_delay)
+
+    def _begin(self):
+        self.phase_timings = {}
+        self._start_time = self._phase_start = time.monotonic()
+
+    def _end_phase(self, phase_name):
+        now = time.monotonic()
+        self.phase_timings[phase_name] = now - self._phase_start
+        self._phase_start = now
+        hc.console_message([f"{hc.get_current_time()} {phase_name}: {self.phase_timings[phase_name]:.0f}s"],
+                           hc.ConsoleColors.basic)
+
+    def _timed_out(self):
+        return time.monotonic() - self._start_time > self.timeout
+
+    def _describe_instance(self):
+        """The instance, or None while EC2 does not list it yet: describe is eventually consistent, so right after
+        run_instances it can answer InvalidInstanceID.NotFound or no reservations. Callers treat that as pending"""
+        from botocore.exceptions import ClientError
+        try:
+            response = self.ec2_client.describe_instances(InstanceIds=[self.instance_id])
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+                return None
+            raise
+        reservations = response['Reservations']
+        if not reservations or not reservations[0]['Instances']:
+            return None
+        return reservations[0]['Instances'][0]
+
+    def _instance_state(self):
+        """(state name, instance or None)"""
+        instance = self._describe_instance()
+        return (instance['State']['Name'] if instance else 'pending'), instance
+
+    def _status_checks_passed(self):
+        response = self.ec2_client.describe_instance_status(InstanceIds=[self.instance_id])
+        if not response['InstanceStatuses']:
+            return False
+        status = response['InstanceStatuses'][0]
+        return (status['InstanceState']['Name'] == 'running'
+                and status['InstanceStatus']['Details'][0]['Status'] == 'passed')
+
+    def _probe_until_ready(self, host, port, ssh_ready, stop_probe):
+        while not stop_probe.is_set():
+            if probe_ssh(host, port):
+                ssh_ready.set()
+                return
+            stop_probe.wait(cassette.idle_time(1))
+
+    def wait_for_ssh(self, port=22, address=None):
+        """Wait until the instance is running and sshd accepts connections (or full status checks pass,
+        whichever comes first). Returns False on timeout or if the instance stops booting.
+        address (host, port) is probed instead of the public IP when SSH is routed elsewhere."""
+        self._begin()
+        hc.console_message([f"{hc.get_current_time()} Waiting for instance to initialize....."],
+                           hc.ConsoleColors.basic)
+        ssh_ready = threading.Event()
+        stop_probe = threading.Event()
+        probe_thread = None
+        running = False
+        try:
+            for delay in self._delays():
+                if self._timed_out():
+                    hc.console_message([f"Instance {self.instance_id} not reachable after {self.timeout}s"],
+                                       hc.ConsoleColors.error)
+                    return False
+                if not running:
+                    state, instance = self._instance_state()
+                    if state not in ('pending', 'running'):
+                        hc.console_message([f"Instance {self.instance_id} is {state}"], hc.ConsoleColors.error)
+                        return False
+                    public_ip = instance.get('PublicIpAddress') if instance else None
+                    if public_ip and probe_thread is None:
+                        # IP is handed out while pending, so probing can start before the API says running
+                        probe_host, probe_port = address or (public_ip, port)
+                        probe_thread = threading.Thread(target=self._probe_until_ready,
+                                                        args=(probe_host, probe_port, ssh_ready, stop_probe),
+                                                        daemon=True)
+                        probe_thread.start()
+                    if state == 'running':
+                        running = True
+                        self._end_phase('instance running')
+                elif self._status_checks_passed():
+                    self._end_phase('status checks passed')
+                    return True
+                # sleeps until the next poll, but wakes up as soon as the probe reaches sshd
+                if ssh_ready.wait(delay):
+                    if not running:
+                        self._end_phase('instance running')
+                    self._end_phase('sshd accepting connections')
+                    return True
+        finally:
+            stop_probe.set()
+            self.phase_timings['total'] = time.monotonic() - self._start_time
+
+    def wait_for_state(self, target_state='terminated'):
+        """Poll the instance state with backoff until it reaches target_state"""
+        self._begin()
+        for delay in self._delays():
+            state = self._instance_state()[0]
+            if state == target_state:
+                self._end_phase(f"instance {target_state}")
+                self.phase_timings['total'] = time.monotonic() - self._start_time
+                return True
+            if self._timed_out():
+                hc.console_message([f"Instance {self.instance_id} still {state} after {self.timeout}s"],
+                                   hc.ConsoleColors.error)
+                return False
+            hc.console_message(
+                [f"{hc.get_current_time()} Waiting for instance:{self.instance_id} to be {target_state}....."],
+                hc.ConsoleColors.basic)
+            time.sleep(delay)
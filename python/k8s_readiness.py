@@ -0,0 +1,209 @@
+"""Watch-based readiness checks for Kubernetes workloads.
+
+Runs wherever the `kubernetes` client and a kubeconfig are available (the Operator Node after
+`aws eks update-kubeconfig`). Usually sent over SSH by OperatorEc2.wait_for_workloads_ready:
+
+    python3 - --timeout 900 'deployment/madzumo-ops/*' service/madzumo-ops/frontend < k8s_readiness.py
+
+Targets are kind/namespace/name with kind deployment, service or endpoints, and name * for every object of that
+kind in the namespace. Each (kind, namespace) is listed once and then watched from the list's resourceVersion,
+so readiness is noticed the moment the API server reports it. One JSON line is printed per workload when it
+becomes ready, then a summary line. Exit status 0 means every target was ready before the timeout.
+Only the standard library and the kubernetes client are used, the file is executed on its own remotely.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+READINESS_SENTINEL = 'MADZUMO_K8S_READINESS'
+KINDS = ('deployment', 'service', 'endpoints')
+
+
+class ReadinessTarget:
+    def __init__(self, kind, namespace, name):
+        if kind not in KINDS:
+            raise ValueError(f"Unsupported kind '{kind}' (use {', '.join(KINDS)})")
+        self.kind = kind
+        self.namespace = namespace
+        self.name = name
+
+    @classmethod
+    def parse(cls, text):
+        parts = text.split('/')
+        if len(parts) != 3:
+            raise ValueError(f"Target '{text}' must be kind/namespace/name")
+        return cls(*parts)
+
+    @property
+    def label(self):
+        return f"{self.kind}/{self.namespace}/{self.name}"
+
+
+def object_readiness(kind, obj):
+    """(ready, detail) for a deployment, service or endpoints object from the kubernetes client"""
+    if kind == 'deployment':
+        wanted = obj.spec.replicas if obj.spec.replicas is not None else 1
+        status = obj.status
+        available = status.available_replicas or 0
+        updated = status.updated_replicas or 0
+        current = (status.observed_generation or 0) >= (obj.metadata.generation or 0)
+        return current and available >= wanted and updated >= wanted, f"{available}/{wanted} available"
+    if kind == 'service':
+        if obj.spec.type != 'LoadBalancer':
+            return True, obj.spec.type
+        ingress = (obj.status.load_balancer.ingress or []) if obj.status.load_balancer else []
+        address = next((item.hostname or item.ip for item in ingress if item.hostname or item.ip), '')
+        return bool(address), address or 'waiting for load balancer'
+    addresses = sum(len(subset.addresses or []) for subset in (obj.subsets or []))
+    return addresses > 0, f"{addresses} ready addresses"
+
+
+class ReadinessWatcher:
+    """Wait until every target is ready. One thread per (kind, namespace) lists the objects and then follows a
+    watch from that resourceVersion (re-listing if the version expired, HTTP 410).
+    ready_times holds seconds-to-ready per workload, details the last known state of those not ready."""
+
+    def __init__(self, api_client, targets, timeout=900):
+        self.api_client = api_client
+        self.targets = targets
+        self.timeout = timeout
+        self.ready_times = {}
+        self.details = {}
+        self._groups = {}
+        for target in targets:
+            self._groups.setdefault((target.kind, target.namespace), set()).add(target.name)
+        self._seen = {group: {} for group in self._groups}  # {group: {object name: ready}}
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._start_time = 0.0
+
+    def _list_function(self, kind):
+        from kubernetes import client
+        if kind == 'deployment':
+            return client.AppsV1Api(self.api_client).list_namespaced_deployment
+        if kind == 'service':
+            return client.CoreV1Api(self.api_client).list_namespaced_service
+        return client.CoreV1Api(self.api_client).list_namespaced_endpoints
+
+    def _group_ready(self, group):
+        """Call with _condition held"""
+        names, seen = self._groups[group], self._seen[group]
+        if '*' in names:
+            return bool(seen) and all(seen.values())
+        return all(seen.get(name, False) for name in names)
+
+    def all_ready(self):
+        with self._condition:
+            return all(self._group_ready(group) for group in self._groups)
+
+    def _update(self, group, obj, deleted, on_ready):
+        kind, namespace = group
+        name = obj.metadata.name
+        if '*' not in self._groups[group] and name not in self._groups[group]:
+            return
+        ready, detail = (False, 'deleted') if deleted else object_readiness(kind, obj)
+        label = f"{kind}/{namespace}/{name}"
+        with self._condition:
+            if deleted and '*' in self._groups[group]:
+                self._seen[group].pop(name, None)  # a removed object is no longer part of "every object"
+            else:
+                self._seen[group][name] = ready
+            self.details[label] = detail
+            newly_ready = ready and label not in self.ready_times
+            if newly_ready:
+                self.ready_times[label] = time.monotonic() - self._start_time
+            self._condition.notify_all()
+        if newly_ready and on_ready:
+            on_ready(label, self.ready_times[label], detail)
+
+    def _follow(self, group, on_ready):
+        from kubernetes import watch
+        from kubernetes.client.rest import ApiException
+        kind, namespace = group
+        list_function = self._list_function(kind)
+        resource_version = None
+        while not self._stopped.is_set():
+            remaining = self.timeout - (time.monotonic() - self._start_time)
+            if remaining <= 0:
+                return
+            try:
+                if resource_version is None:
+                    listing = list_function(namespace)
+                    resource_version = listing.metadata.resource_version
+                    for obj in listing.items:
+                        self._update(group, obj, False, on_ready)
+                stream = watch.Watch()
+                for event in stream.stream(list_function, namespace, resource_version=resource_version,
+                                           timeout_seconds=max(1, min(int(remaining), 300))):
+                    resource_version = event['object'].metadata.resource_version
+                    self._update(group, event['object'], event['type'] == 'DELETED', on_ready)
+                    if self._stopped.is_set():
+                        stream.stop()
+            except ApiException as ex:
+                if ex.status != 410:
+                    raise
+                resource_version = None  # too old to resume from, list again
+
+    def run(self, on_ready=None):
+        """Returns True once every target is ready, False on timeout. on_ready(label, seconds, detail) is called
+        from the watch threads as each workload becomes ready"""
+        self._start_time = time.monotonic()
+        errors = []
+
+        def follow(group):
+            try:
+                self._follow(group, on_ready)
+            except Exception as ex:
+                errors.append(f"{group[0]}/{group[1]}: {ex}")
+                with self._condition:
+                    self._condition.notify_all()
+
+        for group in self._groups:
+            threading.Thread(target=follow, args=(group,), daemon=True).start()
+        deadline = self._start_time + self.timeout
+        with self._condition:
+            while not all(self._group_ready(group) for group in self._groups) and not errors:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        self._stopped.set()
+        for error in errors:
+            self.details[f"error {len(self.details)}"] = error
+        return self.all_ready() and not errors
+
+
+def remote_command(targets, timeout=900):
+    """Shell command that runs this file on a remote host through python3's stdin"""
+    # the PyInstaller build ships this file as data next to the bundled modules
+    source_dir = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(source_dir, 'k8s_readiness.py')) as file:
+        source = file.read()
+    arguments = ' '.join(f"'{target}'" for target in targets)
+    return f"python3 - --timeout {timeout} {arguments} <<'{READINESS_SENTINEL}'\n{source}\n{READINESS_SENTINEL}\n"
+
+
+def main(arguments):
+    import argparse
+    from kubernetes import client, config
+    parser = argparse.ArgumentParser(description='Wait for Kubernetes workloads to become ready')
+    parser.add_argument('--timeout', type=int, default=900)
+    parser.add_argument('targets', nargs='+', help='kind/namespace/name, name may be *')
+    args = parser.parse_args(arguments)
+    config.load_kube_config()
+    watcher = ReadinessWatcher(client.ApiClient(), [ReadinessTarget.parse(text) for text in args.targets],
+                               args.timeout)
+
+    def report(label, seconds, detail):
+        print(json.dumps({'workload': label, 'seconds': round(seconds, 1), 'detail': detail}), flush=True)
+
+    ready = watcher.run(report)
+    not_ready = {label: detail for label, detail in watcher.details.items() if label not in watcher.ready_times}
+    print(json.dumps({'ready': ready, 'not_ready': not_ready}), flush=True)
+    return 0 if ready else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,33 @@
-import time
+import json
+import re
+from collections import deque
 import helper_config as hc
-import boto3
+import k8s_readiness
 from colorama import Back, Fore, Style
-from ec2_config import Ec2Config
+from ec2_config import Ec2Config, BOOTSTRAP_LOG, BOOTSTRAP_STATUS
 from ssh_client import SSHClient
-from kubernetes import client, config
+from s3_config import S3config
+from artifact_cache import ArtifactCache, TerraformCache, PINNED_ARTIFACTS
+from eks_api import EksApiClient
+from tracing import tracer
+
+# what has to be ready before the site & dashboards can be used: every ecommerce Deployment Available and
+# each LoadBalancer service with a hostname plus endpoints to send traffic to
+WEB_READINESS_TARGETS = ['deployment/madzumo-ops/*', 'service/madzumo-ops/frontend',
+                         'endpoints/madzumo-ops/frontend']
+MONITORING_READINESS_TARGETS = ['service/monitoring/monitoring-kube-prometheus-prometheus',
+                                'endpoints/monitoring/monitoring-kube-prometheus-prometheus',
+                                'service/monitoring/monitoring-grafana', 'endpoints/monitoring/monitoring-grafana']
+# playbooks run with the profile_tasks callback, which ends with one "task name ---- 1.23s" line per task
+PLAYBOOK_PROFILE = 'ANSIBLE_CALLBACKS_ENABLED=ansible.posix.profile_tasks PROFILE_TASKS_TASK_OUTPUT_LIMIT=all'
+PROFILE_TASKS_LINE = re.compile(r'^(?P<task>\S.*?) -{3,} (?P<seconds>\d+(\.\d+)?)s$')
 
 
 class OperatorEc2(Ec2Config):
     def __init__(self, instance_name, key_id='', secret_id='', region="us-east-1"):
         super().__init__(instance_name, key_id, secret_id, region)
         self.terraform_file_location = ''
+        self.terraform_dir = 'madzumo/terraform/aws'
         self.ansible_playbook_location = ''
         self.k8_website = ''
         self.ansible = ''
@@ -18,79 +35,223 @@ class OperatorEc2(Ec2Config):
         self.jenkins = ''
         self.grafana = ''
         self.cluster_status = ''
+        self.readiness_timings = {}
+        self.ansible_task_timings = {}
+        self.bootstrap_timings = {}
+        self.eks_cluster_name = 'madzumo-ops-cluster'
+        # status & readiness queries go straight to the cluster's API server when it can be reached from here
+        self.eks_api = EksApiClient(self, self.eks_cluster_name)
+        # terraform, python & git install while a new Operator Node boots
+        self.user_data = self.render_user_data(self.bootstrap_commands())
+
+    def ssh_session(self):
+        """SSH client for the Operator Node. All sessions share one pooled connection."""
+        return SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
+
+    @staticmethod
+    def bootstrap_commands():
+        """Tools every Operator Node needs. Run as user-data on new nodes, nothing secret in here"""
+        return [
+            "sudo yum -y update",
+            "sudo yum-config-manager --add-repo https://rpm.releases.hashicorp.com/AmazonLinux/hashicorp.repo",
+            "sudo yum -y install terraform",
+            "sudo yum -y install python3",
+            "sudo yum -y install python3-pip",
+            "sudo yum -y install git",
+            """
+            if [ ! -d "madzumo" ]; then
+                git clone https://github.com/madzumo/devOps_pipeline.git madzumo
+            else
+                echo "madzumo folder already exists."
+            fi
+            """,
+        ]
 
     def install_terraform_ansible(self):
         hc.console_message(["Install Terraform + Ansible + Helm"], hc.ConsoleColors.info)
         self.get_aws_keys()
+        ssh_run = self.ssh_session()
 
-        install_script = f"""
-        sudo yum update
-        sudo yum-config-manager --add-repo https://rpm.releases.hashicorp.com/AmazonLinux/hashicorp.repo
-        sudo yum -y install terraform
-        sudo yum install python3
-        sudo yum install python3-pip -y
-        pip install ansible
-        pip install kubernetes
-        sudo yum install git -y
-        if [ ! -d "madzumo" ]; then
-            git clone https://github.com/madzumo/devOps_pipeline.git madzumo
-        else
-            echo "madzumo folder already exists."
-        fi
-        aws configure set aws_access_key_id {self.key_id}
-        aws configure set aws_secret_access_key {self.secret_id}
-        aws configure set default.region {self.region}
-        curl -LO "https://dl.k8s.io/release/$(curl -L -s https://dl.k8s.io/release/stable.txt)/bin/linux/amd64/kubectl"
-        sudo install -o root -g root -m 0755 kubectl /usr/local/bin/kubectl
-        curl -LO https://get.helm.sh/helm-v3.14.3-linux-amd64.tar.gz
-        tar -zxvf helm-v3.14.3-linux-amd64.tar.gz
-        sudo mv linux-amd64/helm /usr/local/bin/helm
-        """
-        # print(f"What we have\n{self.ec2_instance_public_ip}\n{self.ssh_username}\n{self.ssh_key_path}")
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
+        # the user-data bootstrap has been installing the tools since the node started booting
+        bootstrap_status = ssh_run.wait_for_bootstrap(BOOTSTRAP_LOG, BOOTSTRAP_STATUS)
+        commands = []
+        if bootstrap_status == 125:  # node launched without the user-data bootstrap, install over SSH
+            commands += self.bootstrap_commands()
+        elif bootstrap_status != 0:
+            hc.console_message([f"Operator Node bootstrap failed (exit status {bootstrap_status})",
+                                f"Log: {BOOTSTRAP_LOG}"], hc.ConsoleColors.error, total_chars=0)
+            return False
+
+        # one channel for the rest, stopping at the first command that fails. Skipped in the same round trip
+        # when this node already finished the same commands
+        commands += [
+            # first line names the command in timings & traces, keep the keys out of it
+            f"""
+            # aws configure
+            aws configure set aws_access_key_id {self.key_id}
+            aws configure set aws_secret_access_key {self.secret_id}
+            aws configure set default.region {self.region}
+            """,
+            # kubectl, helm & the ansible/kubernetes wheels come from the S3 artifact cache (needs the aws keys above)
+            "# artifact cache\n" + ArtifactCache(S3config(self.s3_temp_bucket)).render_install_script(),
+        ]
+        # the artifact script differs depending on what is cached in S3, fingerprint the pinned versions instead
+        results = ssh_run.run_batch(commands, step_name='operator-bootstrap',
+                                    step_inputs=[commands[:-1], [(x.name, x.version) for x in PINNED_ARTIFACTS]])
+        if ssh_run.step_cached:
+            return True
+        self.bootstrap_timings = {result.name: result.duration for result in results if result.exit_status is not None}
+        hc.console_message(["Operator Node setup:"] +
+                           [f"{result.duration:7.1f}s  {result.name}" for result in results
+                            if result.exit_status is not None], hc.ConsoleColors.basic, total_chars=0)
+        failed = [result for result in results if result.exit_status not in (0, None)]
+        if failed:
+            hc.console_message([f"'{failed[0].name}' failed with exit status {failed[0].exit_status}"] +
+                               failed[0].output_tail, hc.ConsoleColors.error, total_chars=0)
+        return all(result.succeeded for result in results)
 
     def terraform_eks_cluster_up(self):
+        """init with providers & modules restored from S3, save the plan, apply exactly that plan.
+        apply is skipped when the plan finds nothing to change"""
         hc.console_message(["Initialize Terraform"], hc.ConsoleColors.info)
-        install_script = """
-        terraform -chdir=madzumo/terraform/aws init
+        terraform_cache = TerraformCache(S3config(self.s3_temp_bucket), self.terraform_dir)
+        install_script = terraform_cache.render_restore_script()
+        install_script += f"""
+        terraform -chdir={self.terraform_dir} init -input=false || exit 1
         """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
+        install_script += terraform_cache.render_save_script()
+        ssh_run = self.ssh_session()
+        if not ssh_run.run_command(install_script):
+            return False
+
         hc.console_message(["Planning Terraform Install"], hc.ConsoleColors.info)
-        install_script = """
-                terraform -chdir=madzumo/terraform/aws plan
-                """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
-        time.sleep(10)
+        # -detailed-exitcode: 0 = no changes, 1 = error, 2 = changes saved to tfplan
+        install_script = f"""
+        terraform -chdir={self.terraform_dir} plan -input=false -out=tfplan -detailed-exitcode
+        """
+        ssh_run = self.ssh_session()
+        # exit status 2 is not a failure here, so print the plan directly instead of using run_command.
+        # Errors go to stderr, its last lines are repeated in the failure message
+        stderr_tail = deque(maxlen=20)
+        for stream_name, line in ssh_run.stream_command(install_script):
+            print(line)
+            if stream_name == 'stderr':
+                stderr_tail.append(line)
+        if ssh_run.exit_status == 0:
+            hc.console_message(["Infrastructure up to date. Nothing to apply"], hc.ConsoleColors.info)
+            return True
+        if ssh_run.exit_status != 2:
+            reason = ("could not be started over SSH" if ssh_run.exit_status == -1
+                      else f"exit status {ssh_run.exit_status}")
+            hc.console_message([f"Terraform plan failed ({reason})"] + list(stderr_tail), hc.ConsoleColors.error,
+                               total_chars=0)
+            return False
 
         hc.console_message(["Deploy Infrastructure"], hc.ConsoleColors.info)
         hc.console_message(["Waiting on cluster(10 min) Please Wait!"], hc.ConsoleColors.info, total_chars=0)
-        install_script = """
-        terraform -chdir=madzumo/terraform/aws apply -auto-approve
+        install_script = f"""
+        terraform -chdir={self.terraform_dir} apply -input=false tfplan
         """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
-        time.sleep(10)
+        ssh_run = self.ssh_session()
+        return ssh_run.run_command(install_script)
 
     def ansible_apply_playbook(self):
-        hc.console_message(["Deploy app via Ansible on Kubernetes Cluster"], hc.ConsoleColors.info)
+        """Run the full Ansible phase in sequence. The pipeline runs the playbooks side by side instead."""
+        return (self.ansible_prepare_cluster() and self.ansible_deploy_web()
+                and self.ansible_deploy_prometheus())
+
+    def ansible_prepare_cluster(self):
+        hc.console_message(["Prepare Ansible & kubeconfig for EKS Cluster"], hc.ConsoleColors.info)
+        # the collection stays installed on the Operator Node, only fetch it from galaxy the first time
         install_script = f"""
-        ansible-galaxy collection install community.kubernetes
+        if ansible-galaxy collection list kubernetes.core 2>/dev/null | grep -q '^kubernetes.core '; then
+            echo "kubernetes.core collection already installed"
+        else
+            ansible-galaxy collection install community.kubernetes || exit 1
+        fi
         aws eks --region {self.region} update-kubeconfig --name madzumo-ops-cluster
-        ansible-playbook madzumo/ansible/deploy-web.yaml
         """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
+        ssh_run = self.ssh_session()
+        return ssh_run.run_command(install_script)
+
+    def ansible_deploy_web(self):
+        hc.console_message(["Deploy app via Ansible on Kubernetes Cluster"], hc.ConsoleColors.info)
+        return self.run_playbook('deploy-web.yaml', 'web')
 
+    def ansible_deploy_prometheus(self):
         hc.console_message(["Deploy Prometheus and Grafana"], hc.ConsoleColors.info)
-        time.sleep(10)
-        install_script = """
-        ansible-playbook madzumo/ansible/deploy-prometheus.yaml
+        return self.run_playbook('deploy-prometheus.yaml', 'monitoring', show_output=False)
+
+    def run_playbook(self, playbook, label, show_output=True):
+        """Run one of the madzumo/ansible playbooks with per-task profiling. Playbooks run side by side, so each
+        output line is prefixed with [label]. The task timings go to ansible_task_timings[playbook] and the
+        slowest tasks are shown when the playbook ends."""
+        install_script = f"""
+        {PLAYBOOK_PROFILE} ansible-playbook madzumo/ansible/{playbook}
         """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script, False)
+        ssh_run = self.ssh_session()
+        timings = []
+        for stream_name, line in ssh_run.stream_command(install_script):
+            match = PROFILE_TASKS_LINE.match(line.strip())
+            if match:
+                timings.append((match['task'], float(match['seconds'])))
+            elif show_output or stream_name == 'stderr':
+                print(f"[{label}] {line}")
+        self.ansible_task_timings[playbook] = timings
+        if timings:
+            slowest = sorted(timings, key=lambda x: x[1], reverse=True)[:5]
+            hc.console_message([f"{playbook}: {len(timings)} tasks in {sum(x[1] for x in timings):.0f}s, slowest:"] +
+                               [f"{seconds:7.1f}s  {task}" for task, seconds in slowest],
+                               hc.ConsoleColors.basic, total_chars=0)
+        if ssh_run.exit_status != 0:
+            hc.console_message([f"{playbook} failed with exit status {ssh_run.exit_status}"],
+                               hc.ConsoleColors.error, total_chars=0)
+            return False
+        return True
+
+    def wait_for_workloads_ready(self, targets, timeout=900):
+        """Run the watch-based readiness check (k8s_readiness) and report how long each workload took to become
+        ready. Watches the API server directly when it is reachable from here, otherwise runs k8s_readiness.py on
+        the Operator Node. Returns True once all targets are ready."""
+        hc.console_message([f"Waiting for {', '.join(targets)}"], hc.ConsoleColors.info, total_chars=0)
+        start = tracer.now()
+
+        def report_ready(workload, seconds, detail):
+            self.readiness_timings[workload] = seconds
+            tracer.add_span(workload, 'k8s', start, start + seconds, {'detail': detail})
+            print(f"{workload} ready in {seconds:.0f}s ({detail})")
+
+        if self.eks_api.available():
+            ready, watcher = self.eks_api.watch_readiness(targets, timeout, report_ready)
+            not_ready = {workload: detail for workload, detail in watcher.details.items()
+                         if workload not in watcher.ready_times}
+        else:
+            ready, not_ready = self._remote_workloads_ready(targets, timeout, report_ready)
+        for workload, detail in not_ready.items():
+            hc.console_message([f"Not ready: {workload} ({detail})"], hc.ConsoleColors.error, total_chars=0)
+        return ready
+
+    def _remote_workloads_ready(self, targets, timeout, report_ready):
+        """k8s_readiness.py on the Operator Node. Returns (all ready, {workload: detail} of those not ready)"""
+        ssh_run = self.ssh_session()
+        summary = {}
+        for stream_name, line in ssh_run.stream_command(k8s_readiness.remote_command(targets, timeout)):
+            try:
+                report = json.loads(line)
+            except ValueError:
+                print(line)
+                continue
+            if 'workload' in report:
+                report_ready(report['workload'], report['seconds'], report['detail'])
+            else:
+                summary = report
+        return ssh_run.exit_status == 0, summary.get('not_ready', {})
+
+    def wait_for_web_ready(self):
+        return self.wait_for_workloads_ready(WEB_READINESS_TARGETS)
+
+    def wait_for_monitoring_ready(self):
+        return self.wait_for_workloads_ready(MONITORING_READINESS_TARGETS)
 
     def install_prometheus_grafana(self):  # handed off to Ansible to manage
         hc.console_message(["Deploy Prometheus and Setup Grafana"], hc.ConsoleColors.info)
@@ -100,7 +261,7 @@ class OperatorEc2(Ec2Config):
                 kubectl create namespace monitoring
                 helm install monitoring prometheus-community/kube-prometheus-stack -n monitoring
                 """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
+        ssh_run = self.ssh_session()
         ssh_run.run_command(install_script)
         # Check status: kubectl --namespace monitoring get pods -l "release=monitoring"
         # kubectl port-forward service/monitoring-kube-prometheus-prometheus -n monitoring 9090:9090 &
@@ -110,93 +271,82 @@ class OperatorEc2(Ec2Config):
         # Test traffic:
         # kubectl run curl-test --image=radial/busyboxplus:curl -i --tty --rm
 
-    def get_web_url(self):
-        try:
-            install_script = """
-                    kubectl get svc frontend -o=jsonpath='{.status.loadBalancer.ingress[0].hostname}' -n madzumo-ops
-                    """
-            # print(self.ec2_instance_public_ip)
-            # print(self.ssh_username)
-            # print(self.ssh_key_path)
-            ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-            ssh_run.run_command(install_script, show_output=False)
-            self.k8_website = f"http://{ssh_run.command_output}"
-            return True
-        except Exception as ex:
-            print(f"Get web URl Error:\n{ex}")
-            return False
-
-    def get_prometheus_url(self):
+    def get_service_urls(self):
+        """Fill k8_website, prometheus & grafana from a single query over all namespaces"""
         try:
-            install_script = """
-                    kubectl get svc monitoring-kube-prometheus-prometheus -o=jsonpath='{.status.loadBalancer.ingress[0].hostname}' -n monitoring
-                    """
-            # print(self.ec2_instance_public_ip)
-            # print(self.ssh_username)
-            # print(self.ssh_key_path)
-            ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-            ssh_run.run_command(install_script, show_output=False)
-            self.prometheus = f"http://{ssh_run.command_output}"
+            hostnames = self.eks_api.service_hostnames() if self.eks_api.available() else \
+                self._kubectl_service_hostnames()
+            if hostnames is None:
+                return False
+            self.k8_website = f"http://{hostnames.get(('madzumo-ops', 'frontend'), '')}"
+            self.prometheus = f"http://{hostnames.get(('monitoring', 'monitoring-kube-prometheus-prometheus'), '')}"
+            self.grafana = f"http://{hostnames.get(('monitoring', 'monitoring-grafana'), '')}"
             return True
         except Exception as ex:
-            print(f"Get web URl Error:\n{ex}")
+            print(f"Get service URLs Error:\n{ex}")
             return False
 
-    def get_grafana_url(self):
-        try:
-            install_script = """
-                    kubectl get svc monitoring-grafana -o=jsonpath='{.status.loadBalancer.ingress[0].hostname}' -n monitoring
-                    """
-            # print(self.ec2_instance_public_ip)
-            # print(self.ssh_username)
-            # print(self.ssh_key_path)
-            ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-            ssh_run.run_command(install_script, show_output=False)
-            self.grafana = f"http://{ssh_run.command_output}"
-            return True
-        except Exception as ex:
-            print(f"Get web URl Error:\n{ex}")
-            return False
+    def _kubectl_service_hostnames(self):
+        """{(namespace, service name): load balancer hostname} from kubectl on the Operator Node, None on failure"""
+        install_script = """
+                kubectl get svc -A -o=jsonpath='{range .items[*]}{.metadata.namespace} {.metadata.name} {.status.loadBalancer.ingress[0].hostname}{"\\n"}{end}'
+                """
+        ssh_run = self.ssh_session()
+        if not ssh_run.run_command(install_script, show_output=False):
+            return None
+        hostnames = {}
+        for line in ssh_run.command_output.splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                hostnames[(fields[0], fields[1])] = fields[2] if len(fields) == 3 else ''
+        return hostnames
 
-    def terraform_eks_cluster_down(self):
+    def ansible_remove_prometheus(self):
         hc.console_message(["Removing Prometheus and Grafana"], hc.ConsoleColors.info)
-        install_script = """
-        ansible-playbook madzumo/ansible/remove-prometheus.yaml
-        """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
+        return self.run_playbook('remove-prometheus.yaml', 'monitoring')
 
+    def ansible_remove_web(self):
         hc.console_message(["Removing e-commerce app Kubernetes Cluster"], hc.ConsoleColors.info)
-        install_script = """
-        ansible-playbook madzumo/ansible/remove-web.yaml
+        return self.run_playbook('remove-web.yaml', 'web')
+
+    def wait_for_load_balancers_removed(self, timeout=600):
+        """LoadBalancer services keep a finalizer until AWS has deleted their ELB, so watching for the services
+        to disappear means terraform will not hit ELB network interfaces still holding the VPC"""
+        hc.console_message(["Waiting for load balancers to be released"], hc.ConsoleColors.info)
+        install_script = f"""
+        lb_services=$(kubectl get svc -A -o=jsonpath='{{range .items[?(@.spec.type=="LoadBalancer")]}}{{.metadata.namespace}}/{{.metadata.name}}{{"\\n"}}{{end}}')
+        for lb_service in $lb_services; do
+            kubectl wait --for=delete "svc/${{lb_service#*/}}" -n "${{lb_service%%/*}}" --timeout={timeout}s || exit 1
+        done
         """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
-        time.sleep(10)
+        ssh_run = self.ssh_session()
+        return ssh_run.run_command(install_script)
 
+    def terraform_destroy(self):
         hc.console_message(["Removing EKS Cluster & other resources (10 min)", "Please Wait!"],
                            hc.ConsoleColors.info)
-        install_script = """
-        terraform -chdir=madzumo/terraform/aws destroy -auto-approve
+        install_script = f"""
+        terraform -chdir={self.terraform_dir} destroy -input=false -auto-approve
         """
-        ssh_run = SSHClient(self.ec2_instance_public_ip, self.ssh_username, self.ssh_key_path)
-        ssh_run.run_command(install_script)
+        ssh_run = self.ssh_session()
+        if not ssh_run.run_command(install_script):
+            hc.console_message(["Terraform destroy failed. Check output above"], hc.ConsoleColors.error)
+            return False
+        self.eks_api.reset()
 
         hc.console_message(["All resources for EKS cluster removed"], hc.ConsoleColors.info)
+        return True
 
     def get_cluster_status(self):
         try:
-            session = boto3.Session(
-                aws_access_key_id=self.key_id,
-                aws_secret_access_key=self.secret_id,
-                region_name=self.region)
-            eks_client = session.client('eks')
-            response = eks_client.describe_cluster(name='madzumo-ops-cluster')
+            eks_client = self.get_client('eks')
+            response = eks_client.describe_cluster(name=self.eks_cluster_name)
             status = response['cluster']['status']
             if str(status).lower() == 'active':
                 self.cluster_status = Back.BLACK + Fore.YELLOW + Style.BRIGHT + 'UP' + Style.NORMAL
             else:
                 self.cluster_status = status
+            return True
         except Exception as e:
             print(f"Error: {e}")
             return 'unknown'
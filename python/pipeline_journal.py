@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import helper_config as hc
+
+
+class PipelineJournal:
+    """Record of completed pipeline steps so a re-run can resume at the first incomplete one.
+    Each entry keeps a fingerprint of the step's inputs; a step only counts as complete if the fingerprint
+    still matches (e.g. a new Operator Node gets a new instance id and reruns its install).
+    The journal lives in the pipeline S3 bucket and is mirrored to a local file, used when S3 is unavailable."""
+
+    def __init__(self, s3_setup, journal_key='pipeline-journal.json', local_path=''):
+        self.s3_setup = s3_setup
+        self.journal_key = journal_key
+        self.local_path = local_path or os.path.join(os.getcwd(), '.madzumo-journal.json')
+        self._steps = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(*inputs):
+        """Stable hash of the step inputs. Only the hash is stored, so secrets may be part of the inputs"""
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _load(self):
+        """Call with _lock held"""
+        if self._steps is not None:
+            return self._steps
+        body = self.s3_setup.read_object(self.journal_key)
+        if body is None and os.path.exists(self.local_path):
+            with open(self.local_path) as file:
+                body = file.read()
+        try:
+            self._steps = json.loads(body)['steps'] if body else {}
+        except (ValueError, KeyError):
+            hc.console_message(['Pipeline journal unreadable. Starting fresh'], hc.ConsoleColors.warning)
+            self._steps = {}
+        return self._steps
+
+    def _save(self):
+        """Call with _lock held"""
+        body = json.dumps({'steps': self._steps}, indent=2)
+        try:
+            with open(self.local_path, 'w') as file:
+                file.write(body)
+        except OSError as ex:
+            print(f"Error:{ex}")
+        self.s3_setup.write_object(self.journal_key, body)
+
+    def is_complete(self, step_name, fingerprint):
+        with self._lock:
+            entry = self._load().get(step_name)
+        return entry is not None and entry['fingerprint'] == fingerprint
+
+    def record(self, step_name, fingerprint, duration):
+        with self._lock:
+            self._load()[step_name] = {'fingerprint': fingerprint, 'seconds': round(duration, 1),
+                                       'completed': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+            self._save()
+
+    def clear(self):
+        """Forget every step, e.g. once the pipeline is removed"""
+        with self._lock:
+            self._steps = {}
+            if os.path.exists(self.local_path):
+                os.remove(self.local_path)
+            self.s3_setup.delete_object(self.journal_key)
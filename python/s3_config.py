@@ -1,20 +1,35 @@
+import os
+import asyncio
 from aws_madzumo import AWSbase
-import boto3
+from async_core import run_sync
+from tracing import tracer
 
 
 class S3config(AWSbase):
     def __init__(self, bucket_name, key_id='', secret_id='', region="us-east-1"):
         super().__init__(key_id, secret_id, region)
-
-        session = boto3.Session(
-            aws_access_key_id=self.key_id,
-            aws_secret_access_key=self.secret_id,
-            region_name=self.region)
-        self.s3_client = session.client('s3')
-        self.s3_resource = session.resource('s3')
-        # self.s3_client = boto3.client('s3', region_name=self.region)
         self.bucket_name = bucket_name
 
+    @property
+    def s3_client(self):
+        return self.get_client('s3')
+
+    @property
+    def s3_resource(self):
+        return self.get_resource('s3')
+
+    def list_bucket_keys(self, prefix=''):
+        """Return {key: size} for every object under prefix"""
+        keys = {}
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+                for item in page.get('Contents', []):
+                    keys[item['Key']] = item['Size']
+        except Exception as ex:
+            print(f"Error:{ex}")
+        return keys
+
     def list_s3_buckets(self):
         for bucket in self.s3_resource.buckets.all():
             print(bucket.name)
@@ -33,7 +48,8 @@ class S3config(AWSbase):
         the file name
         """
         try:
-            self.s3_client.upload_file(full_file_path, self.bucket_name, file_name)
+            with tracer.span(f"upload {file_name}", 's3', bytes=os.path.getsize(full_file_path)):
+                self.s3_client.upload_file(full_file_path, self.bucket_name, file_name)
         except Exception as ex:
             print(f"Error:{ex}")
             return False
@@ -54,21 +70,66 @@ class S3config(AWSbase):
         you want to save the file on the host including the file name.
         """
         try:
-            self.s3_resource.meta.client.download_file(self.bucket_name, file_name, full_save_location)
+            with tracer.span(f"download {file_name}", 's3') as span:
+                self.s3_resource.meta.client.download_file(self.bucket_name, file_name, full_save_location)
+                span['bytes'] = os.path.getsize(full_save_location)
         except Exception as ex:
             print(f"Error:{ex}")
             return False
         return True
 
-    def delete_bucket_contents(self):
-        bucket = self.s3_resource.Bucket(self.bucket_name)
+    def read_object(self, key):
+        """Return the object body as text, or None if it does not exist or can't be read"""
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read().decode()
+        except Exception:
+            return None
+
+    def write_object(self, key, body):
         try:
-            bucket.objects.delete()
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=body.encode())
         except Exception as ex:
             print(f"Error:{ex}")
             return False
         return True
 
+    def delete_object(self, key):
+        try:
+            self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+        except Exception as ex:
+            print(f"Error:{ex}")
+            return False
+        return True
+
+    def delete_bucket_contents(self):
+        try:
+            return run_sync(self.delete_bucket_contents_async())
+        except Exception as ex:
+            print(f"Error:{ex}")
+            return False
+
+    async def delete_bucket_contents_async(self, batch_size=1000):
+        """Delete every object version & delete marker (plain objects too on an unversioned bucket).
+        Each list_object_versions page of batch_size becomes one delete_objects call (1000 is the S3 maximum)
+        and all delete calls run concurrently once the listing is complete"""
+        batches = []
+        # listed on the aws_executor like the deletes, the paginator blocks
+        pages = await self.async_api.paginate('s3', 'list_object_versions', Bucket=self.bucket_name,
+                                              PaginationConfig={'PageSize': batch_size})
+        for page in pages:
+            objects = [{'Key': item['Key'], 'VersionId': item['VersionId']}
+                       for item in page.get('Versions', []) + page.get('DeleteMarkers', [])]
+            batches += [objects[start:start + batch_size] for start in range(0, len(objects), batch_size)]
+        responses = await asyncio.gather(*(self.async_api.call('s3', 'delete_objects', Bucket=self.bucket_name,
+                                                               Delete={'Objects': batch, 'Quiet': True})
+                                           for batch in batches))
+        errors = []
+        for response in responses:
+            errors += response.get('Errors', [])
+        for error in errors[:10]:
+            print(f"Error: unable to delete {error['Key']}: {error['Message']}")
+        return not errors
+
     def check_if_bucket_exists(self):
         try:
             # Try to get metadata about the bucket (this will not incur data transfer costs)
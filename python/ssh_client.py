@@ -1,22 +1,223 @@
-import paramiko
 import os
+import threading
+import atexit
+import asyncio
+import time
+import shlex
+import hashlib
+import json
+import uuid
+from collections import deque
+import cassette
+from async_core import run_blocking, run_sync, transfer_executor
+from tracing import tracer
+
+
+class SSHSessionPool:
+    """Keep one authenticated SSH connection alive per (host, username, key file).
+    Every command opens a new channel on the shared transport instead of paying a new TCP + key exchange.
+    Dead transports are detected with a keepalive probe and reconnected on the next request."""
+
+    def __init__(self, keepalive_interval=30, connect_timeout=30, connect_attempts=5, retry_delay=3):
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+        self.connect_attempts = connect_attempts
+        self.retry_delay = retry_delay
+        # (host, port) that every connection goes to instead, e.g. a local sshd for the offline benchmarks
+        self.address_override = None
+        self._sessions = {}
+        # _lock only guards the dictionaries. Connecting (up to connect_attempts * connect_timeout) holds the lock
+        # of that one session key, so an unreachable host never blocks the other hosts or discard/close_all
+        self._session_locks = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, hostname, username, keyfile):
+        """Return a connected paramiko client for this host, reconnecting if the old transport died"""
+        session_key = (hostname, username, keyfile)
+        with self._lock:
+            session_lock = self._session_locks.setdefault(session_key, threading.Lock())
+        with session_lock:
+            with self._lock:
+                client = self._sessions.get(session_key)
+            if client is not None:
+                if self._is_alive(client):
+                    return client
+                with self._lock:
+                    if self._sessions.get(session_key) is client:
+                        del self._sessions[session_key]
+                client.close()
+
+            client = self._connect(hostname, username, keyfile)
+            with self._lock:
+                self._sessions[session_key] = client
+            return client
+
+    def _connect(self, hostname, username, keyfile):
+        """A freshly booted node can accept on port 22 before cloud-init has installed the key, so retry briefly"""
+        import paramiko  # loaded on the first connection, not when the menu starts
+        for attempt in range(1, self.connect_attempts + 1):
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            host, port = self.address_override or (hostname, 22)
+            try:
+                client.connect(host, port=port, username=username, key_filename=keyfile,
+                               timeout=self.connect_timeout)
+                client.get_transport().set_keepalive(self.keepalive_interval)
+                return client
+            except (paramiko.SSHException, OSError):
+                client.close()
+                if attempt == self.connect_attempts:
+                    raise
+                time.sleep(self.retry_delay)
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+            return True
+        except Exception:
+            return False
+
+    def discard(self, hostname, username, keyfile):
+        """Close and forget the connection for this host so the next request reconnects"""
+        with self._lock:
+            client = self._sessions.pop((hostname, username, keyfile), None)
+        if client is not None:
+            client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._sessions.values())
+            self._sessions.clear()
+        for client in clients:
+            client.close()
+
+
+ssh_pool = SSHSessionPool()
+atexit.register(ssh_pool.close_all)
+
+
+class _LineBuffer:
+    """Split a byte stream into decoded lines. A partial line longer than max_line_bytes is flushed as-is
+    so one runaway line (progress bars, minified json) cannot grow the buffer without bound."""
+
+    def __init__(self, max_line_bytes=65536):
+        self.max_line_bytes = max_line_bytes
+        self._pending = b''
+
+    def feed(self, data):
+        self._pending += data
+        *lines, self._pending = self._pending.split(b'\n')
+        if len(self._pending) > self.max_line_bytes:
+            lines.append(self._pending)
+            self._pending = b''
+        return [line.rstrip(b'\r').decode(errors='replace') for line in lines]
+
+    def flush(self):
+        if not self._pending:
+            return []
+        line, self._pending = self._pending, b''
+        return [line.rstrip(b'\r').decode(errors='replace')]
+
+
+STEP_MARKER_DIR = '~/.madzumo/steps'
+STEP_CACHED = 'MADZUMO_STEP_CACHED'
+
+
+def step_fingerprint(content, inputs=None):
+    """sha256 of a remote script (or list of commands) and whatever else decides its outcome"""
+    return hashlib.sha256(json.dumps([content, inputs], default=str).encode()).hexdigest()
+
+
+def render_cached_step(name, fingerprint, script):
+    """Wrap a script so it only runs when ~/.madzumo/steps/<name> does not hold this fingerprint. The check runs in
+    the same shell as the script, so a step that is already done costs one round trip. After the script exits 0
+    the marker records the fingerprint and when it finished."""
+    marker = f"{STEP_MARKER_DIR}/{name}"
+    return '\n'.join([
+        f"# step {name}",
+        f"if [ \"$(head -n 1 {marker} 2>/dev/null)\" = \"{fingerprint}\" ]; then",
+        f"    echo \"{STEP_CACHED} {name} $(tail -n 1 {marker})\"",
+        "    exit 0",
+        "fi",
+        "{",
+        script.strip('\n'),
+        "}",
+        "step_status=$?",
+        f"if [ $step_status -eq 0 ]; then mkdir -p {STEP_MARKER_DIR} && "
+        f"printf '%s\\nok %s\\n' \"{fingerprint}\" \"$(date -u +%Y-%m-%dT%H:%M:%SZ)\" > {marker}; fi",
+        "exit $step_status",
+    ]) + '\n'
+
+
+class CommandResult:
+    """Outcome of one command of SSHClient.run_batch. exit_status stays None for a command that never ran
+    (an earlier one failed with stop_on_failure)"""
+
+    def __init__(self, command):
+        self.command = command
+        self.exit_status = None
+        self.duration = 0.0
+        self.output_tail = []
+        self.cached = False
+
+    @property
+    def name(self):
+        """First non-blank line of the command"""
+        for line in self.command.splitlines():
+            if line.strip():
+                return line.strip()[:80]
+        return 'remote command'
+
+    @property
+    def succeeded(self):
+        return self.exit_status == 0
+
+
+def render_batch(commands, marker, stop_on_failure=True):
+    """Shell script running the commands in order in one shell, each framed by
+    `<marker> <index> start` & `<marker> <index> end <exit status>` lines on stdout. stderr of every command is
+    merged into stdout so its output stays in order with the frames. The script exits non-zero if any command
+    failed."""
+    lines = [f"# batch of {len(commands)} commands", f"batch_marker={marker}", "batch_failures=0"]
+    for index, command in enumerate(commands):
+        lines += [f'echo "$batch_marker {index} start"', '{', command.strip('\n'), '} 2>&1', 'batch_status=$?',
+                  f'echo "$batch_marker {index} end $batch_status"']
+        if stop_on_failure:
+            lines.append('[ $batch_status -eq 0 ] || exit $batch_status')
+        else:
+            lines.append('[ $batch_status -eq 0 ] || batch_failures=$((batch_failures + 1))')
+    lines.append('[ $batch_failures -eq 0 ]')
+    return '\n'.join(lines) + '\n'
+
 
 class SSHClient:
     """Run commands on remote Linux server interactively.
-    Initiate with host, username & key file path."""
+    Initiate with host, username & key file path.
+    Connections come from the shared ssh_pool so every SSHClient for the same host reuses one transport."""
 
-    def __init__(self, hostname, username, keyfile):
+    def __init__(self, hostname, username, keyfile, pool=ssh_pool):
         self.hostname = hostname
         self.username = username
         self.shell_command = ''
         self.ssh_key_file = keyfile
-        self.client = paramiko.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.pool = pool
+        self.client = None
         self.command_output = ''
+        self.stderr_output = ''
+        self.exit_status = None
+        self.command_duration = 0.0
+        self.read_chunk_size = 32768
+        self.max_output_lines = 2000
+        self.poll_interval = 0.05
+        self.step_cached = False
 
     def _connect_open(self):
         try:
-            self.client.connect(self.hostname, username=self.username, key_filename=self.ssh_key_file)
+            self.client = self.pool.get_client(self.hostname, self.username, self.ssh_key_file)
             # print("SSH connection established")
             return True
         except Exception as ex:
@@ -24,68 +225,393 @@ class SSHClient:
             return False
 
     def _connect_close(self):
-        self.client.close()
+        """Connection stays open in the pool. Use _connect_reset to drop it."""
+        self.client = None
+
+    def _connect_reset(self):
+        self.pool.discard(self.hostname, self.username, self.ssh_key_file)
+        self.client = None
+
+    def _open_channel(self):
+        channel = self.client.get_transport().open_session()
+        channel.exec_command(self.shell_command)
+        return channel
+
+    def stream_command(self, execute_command):
+        """Run a command and yield ('stdout' | 'stderr', line) tuples as soon as each line arrives.
+        When the generator finishes, exit_status and command_duration hold the result of the command.
+        exit_status is -1 if the command could not be started."""
+        tape = cassette.current()
+        if tape is not None:
+            yield from tape.stream_command(self, execute_command, self._stream_command)
+        else:
+            yield from self._stream_command(execute_command)
 
-    def _execute_command(self, show_output=True):
+    def _stream_command(self, execute_command):
+        self.shell_command = execute_command
+        self.exit_status = -1
+        start_time = time.monotonic()
+        trace_start = tracer.now()
+        if not self._connect_open():
+            self.command_duration = time.monotonic() - start_time
+            return
+        from paramiko import SSHException
         try:
-            stdin, stdout, stderr = self.client.exec_command(self.shell_command)
-            self.command_output = stdout.read().decode()
-            if show_output:
-                print(self.command_output)
-            # print(stderr.read().decode())
+            try:
+                channel = self._open_channel()
+            except SSHException:
+                # transport dropped between the liveness check and opening the channel. Reconnect once
+                self._connect_reset()
+                if not self._connect_open():
+                    self.command_duration = time.monotonic() - start_time
+                    return
+                channel = self._open_channel()
         except Exception as ex:
             print(f"An error occurred: {ex}")
+            self._connect_close()
+            self.command_duration = time.monotonic() - start_time
+            return
 
-    def run_command(self, execute_command, show_output=True):
-        """Include the command you want to run via SSH"""
-        self.shell_command = execute_command
-        if self._connect_open():
-            self._execute_command(show_output)
+        stdout_lines = _LineBuffer()
+        stderr_lines = _LineBuffer()
+        counters = {'bytes': 0, 'lines': 0}
+        try:
+            while True:
+                received = False
+                if channel.recv_ready():
+                    received = True
+                    data = channel.recv(self.read_chunk_size)
+                    counters['bytes'] += len(data)
+                    for line in stdout_lines.feed(data):
+                        counters['lines'] += 1
+                        yield 'stdout', line
+                if channel.recv_stderr_ready():
+                    received = True
+                    data = channel.recv_stderr(self.read_chunk_size)
+                    counters['bytes'] += len(data)
+                    for line in stderr_lines.feed(data):
+                        counters['lines'] += 1
+                        yield 'stderr', line
+                if not received:
+                    if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                        break
+                    time.sleep(self.poll_interval)
+            for line in stdout_lines.flush():
+                yield 'stdout', line
+            for line in stderr_lines.flush():
+                yield 'stderr', line
+            self.exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
             self._connect_close()
+            self.command_duration = time.monotonic() - start_time
+            tracer.add_span(self._trace_name(), 'ssh', trace_start, tracer.now(),
+                            dict(counters, exit_status=self.exit_status, host=self.hostname))
+
+    def _trace_name(self):
+        """First non-blank line of the command, which is enough to tell the scripts apart"""
+        for line in self.shell_command.splitlines():
+            if line.strip():
+                return line.strip()[:80]
+        return 'remote command'
+
+    def run_command(self, execute_command, show_output=True):
+        """Include the command you want to run via SSH. Output is printed line by line as it arrives.
+        Returns True if the command exited with status 0. command_output & stderr_output keep the last
+        max_output_lines lines of each stream."""
+        stdout_tail = deque(maxlen=self.max_output_lines)
+        stderr_tail = deque(maxlen=self.max_output_lines)
+        for stream_name, line in self.stream_command(execute_command):
+            if stream_name == 'stdout':
+                stdout_tail.append(line)
+            else:
+                stderr_tail.append(line)
+            if show_output:
+                print(line)
+        self.command_output = '\n'.join(stdout_tail)
+        self.stderr_output = '\n'.join(stderr_tail)
+        if self.exit_status != 0 and show_output:
+            print(f"Command exited with status {self.exit_status} after {self.command_duration:.1f}s")
+        return self.exit_status == 0
+
+    def _step_cached(self, line):
+        """True for the line a cached step prints instead of running (see render_cached_step)"""
+        if not line.startswith(STEP_CACHED):
+            return False
+        self.step_cached = True
+        print(f"Skipped, already done on {self.hostname}: {line[len(STEP_CACHED):].strip()}")
+        return True
+
+    def wait_for_bootstrap(self, log_path, status_path, timeout=1200):
+        """Follow the log of a user-data bootstrap (Ec2Config.render_user_data) until its status file appears,
+        on one channel. Returns the bootstrap's exit status: 0 = done, 124 = timed out and 125 = cloud-init
+        finished without running a bootstrap (the instance was launched without one)."""
+        install_script = f"""
+        printed=0
+        for second in $(seq {timeout}); do
+            finished=0
+            [ -f {status_path} ] && finished=1
+            if [ -f {log_path} ]; then
+                lines=$(wc -l < {log_path})
+                if [ "$lines" -gt "$printed" ]; then
+                    sed -n "$((printed + 1)),${{lines}}p" {log_path}
+                    printed=$lines
+                fi
+            fi
+            if [ $finished -eq 1 ]; then
+                exit "$(cat {status_path})"
+            fi
+            if [ -f /var/lib/cloud/instance/boot-finished ] && [ ! -f {log_path} ]; then
+                echo "No bootstrap ran on this instance"
+                exit 125
+            fi
+            sleep 1
+        done
+        echo "Bootstrap still running after {timeout}s"
+        exit 124
+        """
+        self.run_command(install_script, show_output=True)
+        return self.exit_status
+
+    def run_batch(self, commands, stop_on_failure=True, show_output=True, tail_lines=20, step_name='',
+                  step_inputs=None):
+        """Run the commands one after another over a single channel, in the same shell (cd & exported variables
+        carry over). Returns a CommandResult per command with its exit status, duration & last tail_lines lines of
+        output. With stop_on_failure nothing runs after the first failing command.
+        Every command is also recorded as its own trace span.
+        With a step_name the batch is a cached step (see render_cached_step): skipped when the same commands or,
+        when given, step_inputs already succeeded on this host. Then every result has cached set and exit status 0
+        and step_cached is True."""
+        marker = f"MADZUMO_BATCH_{uuid.uuid4().hex[:12]}"
+        results = [CommandResult(command) for command in commands]
+        current = None
+        started = 0.0
+        trace_start = 0.0
+        tail = deque(maxlen=tail_lines)
+        self.step_cached = False
+        script = render_batch(commands, marker, stop_on_failure)
+        if step_name:
+            fingerprint = step_fingerprint(commands if step_inputs is None else step_inputs)
+            script = render_cached_step(step_name, fingerprint, script)
+        for stream_name, line in self.stream_command(script):
+            if step_name and self._step_cached(line):
+                for result in results:
+                    result.exit_status = 0
+                    result.cached = True
+                continue
+            output, found, frame = line.partition(marker)
+            if output or not found:
+                tail.append(output)
+                if show_output:
+                    print(output)
+            if not found:
+                continue
+            index, event, *status = frame.split()
+            if event == 'start':
+                current = results[int(index)]
+                started = time.monotonic()
+                trace_start = tracer.now()
+                tail.clear()
+            elif current is not None:
+                current.exit_status = int(status[0])
+                current.duration = time.monotonic() - started
+                current.output_tail = list(tail)
+                tracer.add_span(current.name, 'ssh', trace_start, tracer.now(),
+                                {'exit_status': current.exit_status, 'host': self.hostname, 'batch': marker})
+                current = None
+        if current is not None:
+            # the shell itself went away inside this command (exit in the command, lost connection)
+            current.exit_status = self.exit_status if self.exit_status not in (0, None) else -1
+            current.duration = time.monotonic() - started
+            current.output_tail = list(tail)
+        return results
 
-    def ensure_remote_dir(self, sftp, remote_directory):
-        """Ensure that the remote directory exists, create it if necessary."""
+    def ensure_remote_dir(self, sftp, remote_directory, known_dirs=None):
+        """Ensure that the remote directory exists, create it if necessary.
+        known_dirs is a set of directories already present. It is checked first & updated, saving a stat per path."""
+        known_dirs = set() if known_dirs is None else known_dirs
         # Split the path to get all directories and subdirectories
         dirs = remote_directory.split('/')
-        current_dir = ''
+        current_dir = '/' if remote_directory.startswith('/') else ''
         for dir_x in dirs:
             if dir_x:  # This skips empty strings to avoid issues with leading '/'
-                current_dir += '/' + dir_x  # Construct the path with UNIX-like separators
+                current_dir = f"{current_dir}/{dir_x}" if current_dir not in ('', '/') else current_dir + dir_x
+                if current_dir in known_dirs:
+                    continue
                 try:
                     sftp.stat(current_dir)
                 except FileNotFoundError:
                     sftp.mkdir(current_dir)
                     print(f"Created remote directory: {current_dir}")
+                known_dirs.add(current_dir)
 
     def copy_contents(self, local_path, remote_path):
         """
-        Copy a file or all contents of a folder. IF it's file you must name the file from and to destination.
-        Same with folder.
+        Copy a file or all contents of a folder (recursively). IF it's file you must name the file from and to
+        destination. Same with folder. Unchanged files are skipped. Returns True if every file made it.
         """
-        if self._connect_open():
-            scp = paramiko.SFTPClient.from_transport(self.client.get_transport())
-            try:
-                if os.path.isdir(local_path):
-                    for item in os.listdir(local_path):
-                        local_item_path = os.path.join(local_path, item)
-                        remote_item_path = os.path.join(remote_path, item).replace('\\',
-                                                                                   '/')
-                        if os.path.isfile(local_item_path):
-                            # Ensure the remote directory exists before copying
-                            self.ensure_remote_dir(scp, os.path.dirname(remote_item_path))
-                            scp.put(local_item_path, remote_item_path)
-                            print(f"Copied file: {local_item_path} to {remote_item_path}")
-                elif os.path.isfile(local_path):
-                    # Ensure the remote directory exists before copying
-                    self.ensure_remote_dir(scp, os.path.dirname(remote_path))
-                    scp.put(local_path, remote_path)
-                    print(f"Copied file: {local_path} to {remote_path}")
-                else:
-                    print("The specified local_path does not exist or is not accessible.")
-            except Exception as e:
-                print(f"Error copying contents:{e}\n{local_path}\n{remote_path}")
-            finally:
-                scp.close()
-                self.client.close()
-        else:
-            print("Failed to open connection.")
\ No newline at end of file
+        tape = cassette.current()
+        if tape is not None:
+            return tape.call('sync', f"{self.hostname} {local_path} {remote_path}",
+                             lambda: DirectorySync(self).sync(local_path, remote_path))
+        return DirectorySync(self).sync(local_path, remote_path)
+
+
+class DirectorySync:
+    """Push a local file or folder tree to the remote host.
+    One remote `find` lists what is already there (sizes, mtimes & directories), files whose size and mtime match
+    are skipped, same-size files with a different mtime are compared by sha256 in one batch, and the rest are
+    gathered onto the transfer executor, at most `channels` at a time, each worker thread with its own SFTP
+    channel on the pooled transport and pipelined writes.
+    Uploaded files get the local mtime so the next sync can skip them without hashing."""
+
+    def __init__(self, ssh_client, channels=4, chunk_size=32768):
+        self.ssh_client = ssh_client
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self.remote_dirs = set()
+        self.stats = {}
+        self._thread_local = threading.local()
+        self._sftp_clients = []
+        self._sftp_lock = threading.Lock()
+
+    @staticmethod
+    def _local_files(local_path, remote_path):
+        """[(local file, remote file, size, mtime)]"""
+        if os.path.isfile(local_path):
+            file_stat = os.stat(local_path)
+            return [(local_path, remote_path, file_stat.st_size, int(file_stat.st_mtime))]
+        files = []
+        for root, _, file_names in os.walk(local_path):
+            for file_name in sorted(file_names):
+                local_file = os.path.join(root, file_name)
+                relative_path = os.path.relpath(local_file, local_path).replace('\\', '/')
+                file_stat = os.stat(local_file)
+                files.append((local_file, f"{remote_path.rstrip('/')}/{relative_path}", file_stat.st_size,
+                              int(file_stat.st_mtime)))
+        return files
+
+    def _remote_listing(self, remote_path):
+        """{remote file: (size, mtime)} for everything under remote_path, and fills the known directory cache"""
+        listing = {}
+        command = (f"find {shlex.quote(remote_path)} \\( -type f -printf 'f %s %T@ %p\\n' \\) "
+                   f"-o \\( -type d -printf 'd 0 0 %p\\n' \\) 2>/dev/null; true")
+        for stream_name, line in self.ssh_client.stream_command(command):
+            fields = line.split(' ', 3)
+            if stream_name != 'stdout' or len(fields) != 4:
+                continue
+            if fields[0] == 'd':
+                self.remote_dirs.add(fields[3].rstrip('/'))
+            else:
+                listing[fields[3]] = (int(fields[1]), int(float(fields[2])))
+        return listing
+
+    def _remote_hashes(self, remote_files):
+        hashes = {}
+        if not remote_files:
+            return hashes
+        command = 'sha256sum ' + ' '.join(shlex.quote(remote_file) for remote_file in remote_files)
+        for stream_name, line in self.ssh_client.stream_command(command):
+            fields = line.split('  ', 1)
+            if stream_name == 'stdout' and len(fields) == 2:
+                hashes[fields[1]] = fields[0]
+        return hashes
+
+    @staticmethod
+    def _local_hash(local_file):
+        digest = hashlib.sha256()
+        with open(local_file, 'rb') as file:
+            for chunk in iter(lambda: file.read(1048576), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _sftp(self):
+        """One SFTP channel per worker thread"""
+        sftp = getattr(self._thread_local, 'sftp', None)
+        if sftp is None:
+            from paramiko import SFTPClient
+            sftp = SFTPClient.from_transport(self.ssh_client.client.get_transport())
+            self._thread_local.sftp = sftp
+            with self._sftp_lock:
+                self._sftp_clients.append(sftp)
+        return sftp
+
+    def _upload(self, local_file, remote_file, mtime):
+        sftp = self._sftp()
+        with open(local_file, 'rb') as source, sftp.open(remote_file, 'wb') as target:
+            target.set_pipelined(True)  # don't wait for an ack per write
+            for chunk in iter(lambda: source.read(self.chunk_size), b''):
+                target.write(chunk)
+        sftp.utime(remote_file, (mtime, mtime))
+        sftp.chmod(remote_file, os.stat(local_file).st_mode & 0o777)
+
+    async def _upload_all(self, changed):
+        """Upload every changed file. Returns one result per file, the exception if that upload failed"""
+        channel_slots = asyncio.Semaphore(self.channels)
+
+        async def upload(local_file, remote_file, mtime):
+            async with channel_slots:
+                await run_blocking(transfer_executor, self._upload, local_file, remote_file, mtime)
+
+        return await asyncio.gather(*(upload(local_file, remote_file, mtime)
+                                      for local_file, remote_file, size, mtime in changed), return_exceptions=True)
+
+    def sync(self, local_path, remote_path):
+        if not os.path.exists(local_path):
+            print("The specified local_path does not exist or is not accessible.")
+            return False
+        start_time = time.monotonic()
+        trace_start = tracer.now()
+        local_files = self._local_files(local_path, remote_path)
+        remote_files = self._remote_listing(remote_path)
+
+        changed, needs_hash = [], []
+        for local_file, remote_file, size, mtime in local_files:
+            remote_stat = remote_files.get(remote_file)
+            if remote_stat is None or remote_stat[0] != size:
+                changed.append((local_file, remote_file, size, mtime))
+            elif remote_stat[1] != mtime:
+                needs_hash.append((local_file, remote_file, size, mtime))
+        remote_hashes = self._remote_hashes([item[1] for item in needs_hash])
+        for item in needs_hash:
+            if remote_hashes.get(item[1]) != self._local_hash(item[0]):
+                changed.append(item)
+
+        if not self.ssh_client._connect_open():
+            print("Failed to open connection.")
+            return False
+        failed = []
+        try:
+            sftp = self._sftp()
+            for remote_dir in sorted({os.path.dirname(item[1]) for item in changed}):
+                if remote_dir:
+                    self.ssh_client.ensure_remote_dir(sftp, remote_dir, self.remote_dirs)
+            for (local_file, remote_file, size, mtime), result in zip(changed, run_sync(self._upload_all(changed))):
+                if isinstance(result, Exception):
+                    failed.append(local_file)
+                    print(f"Error copying contents:{result}\n{local_file}\n{remote_file}")
+            # same content, different mtime. Stamp the local mtime so next time size+mtime is enough
+            for local_file, remote_file, size, mtime in needs_hash:
+                if (local_file, remote_file, size, mtime) not in changed:
+                    sftp.utime(remote_file, (mtime, mtime))
+        except Exception as e:
+            print(f"Error copying contents:{e}\n{local_path}\n{remote_path}")
+            return False
+        finally:
+            for sftp in self._sftp_clients:
+                sftp.close()
+            self._sftp_clients = []
+            self._thread_local = threading.local()
+            self.ssh_client._connect_close()
+
+        elapsed = max(time.monotonic() - start_time, 0.001)
+        bytes_sent = sum(item[2] for item in changed if item[0] not in failed)
+        tracer.add_span(f"sync {local_path}", 'ssh', trace_start, tracer.now(),
+                        {'bytes': bytes_sent, 'files': len(changed) - len(failed)})
+        self.stats = {'files': len(local_files), 'copied': len(changed) - len(failed),
+                      'skipped': len(local_files) - len(changed), 'failed': len(failed),
+                      'bytes': bytes_sent, 'seconds': elapsed}
+        print(f"Synced {local_path} to {remote_path}: {self.stats['copied']} copied, {self.stats['skipped']} "
+              f"unchanged, {self.stats['failed']} failed, {bytes_sent / 1048576:.1f} MB in {elapsed:.1f}s "
+              f"({bytes_sent / 1048576 / elapsed:.1f} MB/s)")
+        return not failed
@@ -1,10 +1,9 @@
+import os
 import sys
 import helper_config as hc
-from s3_config import S3config
-from ec2_config import Ec2Config
-from operator_config import OperatorEc2
-from status_config import StatusPage
 from enum import Enum
+# pipeline, AWS & SSH modules (boto3, paramiko, asyncio, concurrent.futures) are imported where an option first
+# needs them, so the menu shows up without loading them. benchmarks/bench_import_time.py keeps startup within budget
 
 
 class MenuOptions(Enum):
@@ -19,14 +18,33 @@ class MenuOptions(Enum):
 class StartDemo:
     """main class to orchestrate the full pipeline demo"""
 
-    def __init__(self, slowdown=False):
+    def __init__(self, slowdown=False, warm_standby=False):
         hc.display_header()
         hc.console_message(hc.welcome_message, hc.ConsoleColors.title)
 
-        self.operator_instance = OperatorEc2('madzumo-ops')
-        self.jenkins_instance = Ec2Config('madzumo-jenkins')
+        self._operator_instance = None
+        self._jenkins_instance = None
         self.menu = MenuOptions
         self.slowdown = slowdown
+        # Remove Existing Pipeline stops the Operator Node & keeps its key pair, security group and S3 bucket,
+        # so the next setup starts it again instead of creating and bootstrapping a new one
+        self.warm_standby = warm_standby
+
+    @property
+    def operator_instance(self):
+        """Created the first time an option needs AWS"""
+        if self._operator_instance is None:
+            from operator_config import OperatorEc2
+            self._operator_instance = OperatorEc2('madzumo-ops')
+            self._operator_instance.warm_standby = self.warm_standby
+        return self._operator_instance
+
+    @property
+    def jenkins_instance(self):
+        if self._jenkins_instance is None:
+            from ec2_config import Ec2Config
+            self._jenkins_instance = Ec2Config('madzumo-jenkins')
+        return self._jenkins_instance
 
     def run_demo(self):
         while True:
@@ -53,56 +71,106 @@ class StartDemo:
             hc.end_of_line()
 
     def _setup_the_show(self):
+        from s3_config import S3config
+        from pipeline_journal import PipelineJournal
+        from artifact_cache import PINNED_ARTIFACTS
+        from step_scheduler import StepScheduler
+        from tracing import tracer
+        from api_metrics import api_metrics
         if self._confirm_the_show():
             hc.console_message(['Please, Do Not Interrupt This Process'], hc.ConsoleColors.warning, total_chars=0)
+            operator = self.operator_instance
+            tracer.reset()
+            api_metrics.reset()
             # 1. test AWS connection
-            if self.operator_instance.check_aws_credentials():
-                if self.slowdown:
-                    hc.console_message(["Step 1 finish"], hc.ConsoleColors.error, total_chars=0, force_pause=True)
-                    hc.pause_console()
-
-                # 2. Setup S3 bucket for storage
-                s3_temp_bucket_name = f"madzumo-ops-{self.operator_instance.aws_account_number}"
-                s3_setup = S3config(s3_temp_bucket_name)
-                if s3_setup.check_if_bucket_exists():
-                    hc.console_message(['Temp S3 bucket exists'], hc.ConsoleColors.info)
-                else:
-                    hc.console_message(['Creating temp S3 bucket'], hc.ConsoleColors.info)
-                    s3_setup.create_bucket()
-                self.operator_instance.s3_temp_bucket = s3_temp_bucket_name
-
-                if self.slowdown:
-                    hc.console_message(["Step 2 finish"], hc.ConsoleColors.error, total_chars=0, force_pause=True)
-
-                # 3. Initialize Operator Node Instance (Terraform & Ansible control node)
-                hc.console_message(['Creating Operator Node'], hc.ConsoleColors.info)
-                self.operator_instance.create_ec2_instance(True)
-
-                if self.slowdown:
-                    hc.console_message(["Step 3 finish"], hc.ConsoleColors.error, total_chars=0, force_pause=True)
-
-                # 4. Install Terraform & Ansible on Operator Node
-                self.operator_instance.install_terraform_ansible()
+            if not operator.check_aws_credentials():
+                return
+            # steps that declare inputs are journaled so a re-run resumes at the first incomplete step
+            journal = PipelineJournal(S3config(f"madzumo-ops-{operator.aws_account_number}"))
+            # slowdown pauses after every step so run them one at a time
+            scheduler = StepScheduler(max_workers=1 if self.slowdown else 4, on_step_done=self._step_finished,
+                                      journal=journal)
+            # 2. Setup S3 bucket for storage. Security group & key pair do not depend on it
+            scheduler.add_step('S3 bucket', self._setup_s3_bucket)
+            scheduler.add_step('Security group', operator.create_security_group)
+            scheduler.add_step('Key pair', operator.create_ec2_key_pair)
+            # 3. Initialize Operator Node Instance (Terraform & Ansible control node). Key pair is backed up to S3
+            scheduler.add_step('Operator node', lambda: operator.create_ec2_instance(True),
+                               requires=['S3 bucket', 'Security group', 'Key pair'])
+            # 4. Install Terraform & Ansible on Operator Node
+            scheduler.add_step('Terraform & Ansible tools', operator.install_terraform_ansible,
+                               requires=['Operator node'],
+                               inputs=lambda: [operator.ec2_instance_id, operator.key_id, operator.secret_id,
+                                               [(x.name, x.version) for x in PINNED_ARTIFACTS]])
+            # 5. use Terraform to deploy eks cluster
+            scheduler.add_step('EKS cluster', operator.terraform_eks_cluster_up,
+                               requires=['Terraform & Ansible tools'],
+                               inputs=lambda: [operator.ec2_instance_id, operator.region])
+            # 6. use Ansible to apply full e-commerce site on k8s including Prometheus and Grafana
+            scheduler.add_step('Kubeconfig', operator.ansible_prepare_cluster, requires=['EKS cluster'],
+                               inputs=lambda: [operator.ec2_instance_id, operator.region])
+            scheduler.add_step('e-commerce app', operator.ansible_deploy_web, requires=['Kubeconfig'],
+                               inputs=lambda: [operator.ec2_instance_id])
+            scheduler.add_step('Prometheus & Grafana', operator.ansible_deploy_prometheus, requires=['Kubeconfig'],
+                               inputs=lambda: [operator.ec2_instance_id])
+            # 7. wait until the workloads are Available and the load balancers have hostnames
+            scheduler.add_step('e-commerce app ready', operator.wait_for_web_ready, requires=['e-commerce app'])
+            scheduler.add_step('Prometheus & Grafana ready', operator.wait_for_monitoring_ready,
+                               requires=['Prometheus & Grafana'])
 
-                if self.slowdown:
-                    hc.console_message(["Step 4 finish"], hc.ConsoleColors.error, total_chars=0, force_pause=True)
+            pipeline_complete = scheduler.run()
+            scheduler.print_timeline()
+            self._report_trace()
+            if not pipeline_complete:
+                self._abort_the_show(', '.join(step.name for step in scheduler.failed_steps()))
+                return
 
-                # 5. use Terraform to deploy eks cluster
-                self.operator_instance.terraform_eks_cluster_up()
+            hc.console_message(['Pipeline Complete!'], hc.ConsoleColors.title)
+            hc.pause_console()
+            hc.clear_console()
+            self._status_of_the_show()
 
-                if self.slowdown:
-                    hc.console_message(["Step 5 finish"], hc.ConsoleColors.error, total_chars=0, force_pause=True)
+    def _setup_s3_bucket(self):
+        from s3_config import S3config
+        s3_temp_bucket_name = f"madzumo-ops-{self.operator_instance.aws_account_number}"
+        s3_setup = S3config(s3_temp_bucket_name)
+        if s3_setup.check_if_bucket_exists():
+            hc.console_message(['Temp S3 bucket exists'], hc.ConsoleColors.info)
+        else:
+            hc.console_message(['Creating temp S3 bucket'], hc.ConsoleColors.info)
+            if not s3_setup.create_bucket():
+                return False
+        self.operator_instance.s3_temp_bucket = s3_temp_bucket_name
+        return True
 
-                # 6. use Ansible to apply full e-commerce site on k8s including Prometheus and Grafana
-                self.operator_instance.ansible_apply_playbook()
+    def _step_finished(self, step):
+        if step.status == 'failed':
+            # a step that returned False without raising leaves no error, its own output above has the details
+            hc.console_message([f"{step.name} failed", step.error or 'step reported failure'], hc.ConsoleColors.error,
+                               total_chars=0)
+        elif step.resumed:
+            hc.console_message([f"{step.name} already complete. Skipping"], hc.ConsoleColors.info, total_chars=0)
+        elif self.slowdown:
+            hc.console_message([f"{step.name} finish"], hc.ConsoleColors.error, total_chars=0, force_pause=True)
 
-                if self.slowdown:
-                    hc.console_message(["Step 6 finish"], hc.ConsoleColors.error, total_chars=0, force_pause=True)
+    @staticmethod
+    def _report_trace():
+        """Slowest spans of this run, AWS API metrics, plus a Chrome trace file with every step, AWS call & remote
+        command"""
+        from tracing import tracer
+        from api_metrics import api_metrics
+        tracer.print_summary()
+        api_metrics.print_summary()
+        try:
+            trace_file = tracer.export_chrome_trace()
+            hc.console_message([f"Trace saved: {trace_file}"], hc.ConsoleColors.info, total_chars=0)
+        except OSError as ex:
+            hc.console_message([f"Unable to save trace: {ex}"], hc.ConsoleColors.error, total_chars=0)
 
-                hc.console_message(['Pipeline Complete!'], hc.ConsoleColors.title)
-                hc.pause_console()
-                hc.clear_console()
-                self._status_of_the_show()
+    @staticmethod
+    def _abort_the_show(step_name):
+        hc.console_message([f'Pipeline stopped. Step failed: {step_name}',
+                            'Fix the error above and run Install Full Pipeline again'], hc.ConsoleColors.error)
 
     def _confirm_the_show(self):
         hc.console_message(['This will install the full pipeline ending with a working e-commerce website',
@@ -118,33 +186,83 @@ class StartDemo:
             return True
 
     def _destroy_the_show(self):
+        from step_scheduler import StepScheduler
+        from tracing import tracer
+        from api_metrics import api_metrics
+        operator = self.operator_instance
+        tracer.reset()
+        api_metrics.reset()
         # 1. test AWS connection
-        if self.operator_instance.check_aws_credentials(False):
+        if operator.check_aws_credentials(False):
             hc.console_message(['REMOVE Pipeline'],hc.ConsoleColors.warning)
             # 2. Populate this workstation with Pipeline data
-            self.operator_instance.populate_ec2_instance()
+            operator_found = operator.populate_ec2_instance()
+
+            # 3. removals ordered by dependency. Independent ones run side by side
+            scheduler = StepScheduler(max_workers=4, on_step_done=self._step_finished)
+            # the journal goes before anything is removed: once a removal has run, the steps it recorded no longer
+            # hold, even if terraform destroy fails halfway. Key pair, security group & bucket are checked anyway
+            scheduler.add_step('Reset pipeline journal', self._reset_journal)
+            if operator_found:
+                # app removal is best effort (the cluster may already be half gone), terraform destroy is not:
+                # the Operator Node holds the terraform state, so it stays until the cluster is removed
+                scheduler.add_step('Remove Prometheus & Grafana', operator.ansible_remove_prometheus,
+                                   requires=['Reset pipeline journal'], optional=True)
+                scheduler.add_step('Remove e-commerce app', operator.ansible_remove_web,
+                                   requires=['Reset pipeline journal'], optional=True)
+                scheduler.add_step('Release load balancers', operator.wait_for_load_balancers_removed,
+                                   requires=['Remove Prometheus & Grafana', 'Remove e-commerce app'], optional=True)
+                scheduler.add_step('Remove EKS cluster', operator.terraform_destroy,
+                                   requires=['Release load balancers'])
+                if self.warm_standby:
+                    scheduler.add_step('Stop Operator node', operator.stop_ec2_instance,
+                                       requires=['Remove EKS cluster'])
+                else:
+                    scheduler.add_step('Remove Operator node', operator.delete_ec2_instance,
+                                       requires=['Remove EKS cluster'])
+            elif not self.warm_standby and operator.get_stopped_instance():
+                # left in warm standby by an earlier run
+                scheduler.add_step('Remove Operator node', operator.delete_ec2_instance,
+                                   requires=['Reset pipeline journal'])
+                operator_found = True
+            # in warm standby key pair, security group & bucket (caches, key backup) stay for the stopped node
+            if not self.warm_standby:
+                scheduler.add_step('Remove local key pair', operator.remove_local_key_pair,
+                                   requires=['Remove Operator node'] if operator_found else [])
+                # 4. the Operator Node uses the S3 bucket (artifact & terraform caches) until the cluster is gone
+                scheduler.add_step('Remove S3 bucket', self._remove_s3_bucket,
+                                   requires=['Remove EKS cluster'] if 'Remove EKS cluster' in scheduler.steps
+                                   else ['Reset pipeline journal'])
+
+            removal_complete = scheduler.run()
+            scheduler.print_timeline()
+            self._report_trace()
+            if not removal_complete:
+                hc.console_message([f"Pipeline removal stopped. Step failed: "
+                                    f"{', '.join(step.name for step in scheduler.failed_steps())}",
+                                    'Fix the error above and run Remove Existing Pipeline again'], hc.ConsoleColors.error)
 
-            # 4. Clean up all Objects & remove instances
-            self.operator_instance.terraform_eks_cluster_down()
-            self.operator_instance.delete_ec2_instance()
-            self.operator_instance.remove_local_key_pair()
+    def _reset_journal(self):
+        from s3_config import S3config
+        from pipeline_journal import PipelineJournal
+        PipelineJournal(S3config(f"madzumo-ops-{self.operator_instance.aws_account_number}")).clear()
+        return True
 
-            # 5. lastly, remove S3 bucket
-            hc.console_message(["Terminating temp S3 bucket"], hc.ConsoleColors.info)
-            s3_setup = S3config(f"madzumo-ops-{self.operator_instance.aws_account_number}")
-            s3_setup.delete_bucket_contents()
-            s3_setup.delete_bucket()
+    def _remove_s3_bucket(self):
+        from s3_config import S3config
+        hc.console_message(["Terminating temp S3 bucket"], hc.ConsoleColors.info)
+        s3_setup = S3config(f"madzumo-ops-{self.operator_instance.aws_account_number}")
+        return s3_setup.delete_bucket_contents() and s3_setup.delete_bucket()
 
     def _status_of_the_show(self):
+        from status_config import StatusPage
         if self.operator_instance.check_aws_credentials():
             sp = StatusPage(self.operator_instance)
             sp.populate_status_page(self.operator_instance.populate_ec2_instance(False))
 
 
 if __name__ == "__main__":
-    slowdown = False
-    if len(sys.argv) > 1:
-        if sys.argv[1] == 'slowdown':
-            slowdown = True
-    start_demo = StartDemo(slowdown=slowdown)
+    slowdown = 'slowdown' in sys.argv[1:]
+    warm_standby = 'warm-standby' in sys.argv[1:] or os.environ.get('MADZUMO_WARM_STANDBY', '') not in ('', '0')
+    start_demo = StartDemo(slowdown=slowdown, warm_standby=warm_standby)
     start_demo.run_demo()
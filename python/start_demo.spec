@@ -5,7 +5,7 @@ a = Analysis(
     ['start_demo.py'],
     pathex=[],
     binaries=[],
-    datas=[],
+    datas=[('k8s_readiness.py', '.')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
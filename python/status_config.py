@@ -1,5 +1,38 @@
 from colorama import Back, Fore, Style
+import asyncio
+import time
 import helper_config as hc
+from async_core import aws_executor, ssh_executor, run_blocking, run_sync
+
+
+class StatusCollector:
+    """Query every status source at the same time and record how long each one took"""
+
+    def __init__(self, operator):
+        self.operator = operator
+        self.timings = {}
+
+    @staticmethod
+    def _timed(source):
+        start_time = time.monotonic()
+        source()
+        return time.monotonic() - start_time
+
+    async def collect_async(self):
+        sources = {
+            'Kubernetes services': (ssh_executor, self.operator.get_service_urls),
+            'EKS cluster': (aws_executor, self.operator.get_cluster_status),
+        }
+        seconds = await asyncio.gather(*(run_blocking(executor, self._timed, source)
+                                         for executor, source in sources.values()))
+        self.timings = dict(zip(sources, seconds))
+        return self.timings
+
+    def collect(self):
+        return run_sync(self.collect_async())
+
+    def timing_summary(self):
+        return ', '.join(f"{name} {seconds:.1f}s" for name, seconds in self.timings.items())
 
 
 class StatusPage:
@@ -23,11 +56,9 @@ class StatusPage:
         pipeline_status = Back.BLACK + Fore.LIGHTRED_EX + Style.BRIGHT + 'NOT SETUP'
         pipeline_info = ''
         # self.download_key_pair() #unablet to download pem file without corruption of data
+        collector = StatusCollector(self.operator)
         if operator_running:
-            self.operator.get_web_url()
-            self.operator.get_prometheus_url()
-            self.operator.get_grafana_url()
-            self.operator.get_cluster_status()
+            collector.collect()
             pipeline_status = Back.BLACK + Fore.GREEN + Style.BRIGHT + 'ACTIVE' + Style.NORMAL
         else:
             pipeline_status = Back.BLACK + Fore.RED + Style.BRIGHT + 'NOT SETUP' + Style.NORMAL
@@ -49,3 +80,5 @@ class StatusPage:
         # print(Back.RED + Fore.YELLOW + header_text + "\n") # entire back is red
         print(f"{aws_conn_title} {aws_conn_status}\n{aws_conn_info}\n")
         print(f"{pipeline_title} {pipeline_status}\n{pipeline_info}")
+        if collector.timings:
+            hc.console_message([f"Status sources: {collector.timing_summary()}"], hc.ConsoleColors.basic, total_chars=0)
@@ -0,0 +1,163 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import helper_config as hc
+from tracing import tracer
+
+
+class PipelineStep:
+    """One unit of pipeline work. Action is called with no arguments and must return True on success
+    (None also counts as success). Requires is the list of step names that must finish first.
+    An optional step is best effort: its failure is reported but does not hold up the steps after it."""
+
+    def __init__(self, name, action, requires=(), inputs=None, optional=False):
+        self.name = name
+        self.action = action
+        self.requires = list(requires)
+        self.inputs = inputs  # callable returning the step inputs. Only steps with inputs are journaled
+        self.optional = optional
+        self.fingerprint = ''
+        self.resumed = False  # done in an earlier run according to the journal
+        self.status = 'pending'  # pending -> running -> done | failed, or skipped if a dependency failed
+        self.start_time = None
+        self.end_time = None
+        self.error = ''
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+class StepScheduler:
+    """Run pipeline steps as a dependency graph. Every step whose requirements are done is submitted to a
+    thread pool, so independent steps overlap. After the first failure no new steps start, running steps
+    finish, and everything downstream is marked skipped.
+    With a PipelineJournal, steps that declare inputs are recorded when they succeed and skipped on a later run
+    while their input fingerprint is unchanged.
+    on_step_done is called on the calling thread after each step, so it may prompt the user."""
+
+    def __init__(self, max_workers=4, on_step_done=None, journal=None):
+        self.max_workers = max_workers
+        self.on_step_done = on_step_done
+        self.journal = journal
+        self.steps = {}
+        self.start_time = None
+        self.end_time = None
+
+    def add_step(self, name, action, requires=(), inputs=None, optional=False):
+        if name in self.steps:
+            raise ValueError(f"Duplicate pipeline step: {name}")
+        self.steps[name] = PipelineStep(name, action, requires, inputs, optional)
+        return self.steps[name]
+
+    def _validate(self):
+        for step in self.steps.values():
+            for requirement in step.requires:
+                if requirement not in self.steps:
+                    raise ValueError(f"Step '{step.name}' requires unknown step '{requirement}'")
+        # Kahn's algorithm. Anything left over sits on a cycle
+        remaining = {name: set(step.requires) for name, step in self.steps.items()}
+        while remaining:
+            ready = [name for name, requires in remaining.items() if not requires]
+            if not ready:
+                raise ValueError(f"Pipeline steps have a dependency cycle: {', '.join(remaining)}")
+            for name in ready:
+                del remaining[name]
+            for requires in remaining.values():
+                requires.difference_update(ready)
+
+    def _finished(self, step_name):
+        step = self.steps[step_name]
+        return step.status == 'done' or (step.status == 'failed' and step.optional)
+
+    def _ready_steps(self):
+        return [step for step in self.steps.values()
+                if step.status == 'pending' and all(self._finished(requirement) for requirement in step.requires)]
+
+    def _resume_from_journal(self, step):
+        """Inputs are evaluated only once the dependencies are done, since they usually come from them"""
+        if self.journal is None or step.inputs is None:
+            return False
+        step.fingerprint = self.journal.fingerprint(step.inputs())
+        if self.journal.is_complete(step.name, step.fingerprint):
+            step.status = 'done'
+            step.resumed = True
+            return True
+        return False
+
+    @staticmethod
+    def _run_step(step):
+        step.start_time = time.monotonic()
+        try:
+            with tracer.span(step.name, 'step'):
+                return step.action()
+        finally:
+            step.end_time = time.monotonic()
+
+    def run(self):
+        """Run all steps. Returns True if every step that is not optional finished successfully."""
+        self._validate()
+        self.start_time = time.monotonic()
+        failed = False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            running = {}
+            while True:
+                while not failed:
+                    ready_steps = self._ready_steps()
+                    resumed_steps = [step for step in ready_steps if self._resume_from_journal(step)]
+                    for step in ready_steps:
+                        if not step.resumed:
+                            step.status = 'running'
+                            running[pool.submit(self._run_step, step)] = step
+                    if not resumed_steps:
+                        break
+                    for step in resumed_steps:
+                        if self.on_step_done:
+                            self.on_step_done(step)
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        result = future.result()
+                        step.status = 'failed' if result is False else 'done'
+                    except Exception as ex:
+                        step.status = 'failed'
+                        step.error = f"{ex}"
+                    if step.status == 'failed':
+                        failed = failed or not step.optional
+                    elif self.journal is not None and step.inputs is not None:
+                        self.journal.record(step.name, step.fingerprint, step.duration)
+                    if self.on_step_done:
+                        self.on_step_done(step)
+        for step in self.steps.values():
+            if step.status == 'pending':
+                step.status = 'skipped'
+        self.end_time = time.monotonic()
+        return not failed
+
+    def failed_steps(self):
+        return [step for step in self.steps.values() if step.status == 'failed']
+
+    def print_timeline(self, bar_width=40):
+        """Print each step's start offset, duration & status with a bar showing where it ran in the total time"""
+        if self.start_time is None:
+            return
+        total_time = max((self.end_time or time.monotonic()) - self.start_time, 0.001)
+        name_width = max(len(name) for name in self.steps)
+        lines = ['Pipeline Timeline', f"{'Step'.ljust(name_width)} {'Start':>7} {'Time':>8}  Status"]
+        for step in sorted(self.steps.values(), key=lambda x: (x.start_time is None, x.start_time or 0)):
+            if step.start_time is None:
+                status = 'resumed' if step.resumed else step.status
+                lines.append(f"{step.name.ljust(name_width)} {'-':>7} {'-':>8}  {status}")
+                continue
+            offset = step.start_time - self.start_time
+            bar_start = int(offset / total_time * bar_width)
+            bar_length = max(1, int(step.duration / total_time * bar_width))
+            bar = ' ' * bar_start + '#' * bar_length
+            lines.append(f"{step.name.ljust(name_width)} {offset:6.0f}s {step.duration:7.0f}s  "
+                         f"{step.status.ljust(7)} |{bar.ljust(bar_width)}|")
+        lines.append(f"Total: {total_time:.0f}s")
+        hc.console_message(lines, hc.ConsoleColors.info, total_chars=0)
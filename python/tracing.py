@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+import helper_config as hc
+
+
+class Span:
+    def __init__(self, name, category, start, end, thread_id, attributes):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = end
+        self.thread_id = thread_id
+        self.attributes = attributes
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Tracer:
+    """Collects timed spans for pipeline steps, AWS API calls & remote commands from any thread.
+    Spans can be exported as a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev)
+    and summarised as a slowest-spans table."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self._origin = time.perf_counter()
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def add_span(self, name, category, start, end, attributes=None):
+        span = Span(name, category, start, end, threading.get_ident(), attributes or {})
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, category='step', **attributes):
+        """Time the with-block. The yielded dict can be filled with extra attributes (bytes, lines, ...)"""
+        start = self.now()
+        try:
+            yield attributes
+        except Exception as ex:
+            attributes['error'] = f"{ex}"
+            raise
+        finally:
+            self.add_span(name, category, start, self.now(), attributes)
+
+    def export_chrome_trace(self, path=''):
+        """Write all spans in Chrome trace event format. Returns the file path"""
+        path = path or os.path.join(os.getcwd(), f"madzumo-trace-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        with self._lock:
+            spans = list(self.spans)
+        thread_ids = {}
+        events = []
+        for span in spans:
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round((span.start - self._origin) * 1000000),
+                'dur': round(span.duration * 1000000),
+                'pid': os.getpid(),
+                'tid': thread_ids.setdefault(span.thread_id, len(thread_ids) + 1),
+                'args': span.attributes,
+            })
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file, default=str)
+        return path
+
+    def category_totals(self):
+        """{category: (span count, total seconds)}"""
+        totals = {}
+        with self._lock:
+            for span in self.spans:
+                count, seconds = totals.get(span.category, (0, 0.0))
+                totals[span.category] = (count + 1, seconds + span.duration)
+        return totals
+
+    def print_summary(self, limit=10):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda x: x.duration, reverse=True)[:limit]
+        if not spans:
+            return
+        name_width = min(max(len(span.name) for span in spans), 60)
+        lines = [f"Slowest {len(spans)} spans", f"{'Span'.ljust(name_width)} {'Type':<8} {'Time':>8}  Details"]
+        for span in spans:
+            details = ' '.join(f"{key}={value}" for key, value in span.attributes.items())
+            lines.append(f"{span.name[:name_width].ljust(name_width)} {span.category:<8} {span.duration:7.1f}s  "
+                         f"{details[:60]}")
+        totals = ', '.join(f"{category}: {count} in {seconds:.0f}s"
+                           for category, (count, seconds) in self.category_totals().items())
+        lines.append(f"Totals -> {totals}")
+        hc.console_message(lines, hc.ConsoleColors.info, total_chars=0)
+
+
+tracer = Tracer()
+
+
+def _before_aws_call(context, **kwargs):
+    context['madzumo_trace_start'] = tracer.now()
+
+
+def _after_aws_call(http_response, model, context, parsed=None, **kwargs):
+    start = context.get('madzumo_trace_start')
+    if start is None:
+        return
+    attributes = {}
+    retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+        attributes['retries'] = retries
+    if http_response is not None:
+        attributes['status'] = http_response.status_code
+        if http_response.headers.get('content-length'):
+            attributes['bytes'] = int(http_response.headers['content-length'])
+    tracer.add_span(f"{model.service_model.service_name}.{model.name}", 'aws', start, tracer.now(), attributes)
+
+
+def instrument_boto3_client(client):
+    """Record a span for every API call the client makes"""
+    client.meta.events.register('before-call.*.*', _before_aws_call)
+    client.meta.events.register('after-call.*.*', _after_aws_call)
+    return client